@@ -1,2 +1,4 @@
-from .wrapper import model_ihc, model_synapse, seed_rng, get_matlab
-from .cache import get_spiketrain
+from .wrapper import model_ihc, model_synapse, seed_rng, get_matlab, upload
+from .wrapper import get_matlab_pool, set_matlab_workers
+from .cache import get_ihc
+from .cache import get_spiketrain, get_spiketrains, get_misses
@@ -3,9 +3,13 @@ Utilities for generating and caching spike trains from AN model.
 """
 
 import logging
-import os, sys, pickle
+import os, sys, re, time, shutil, hashlib, argparse
 import numpy as np
-from .wrapper import get_matlab, model_ihc, model_synapse, seed_rng
+from .wrapper import get_matlab, get_matlab_pool, model_ihc, model_synapse, seed_rng, upload
+from .shard import SpikeShard
+from ..util.matlab_proc import MatlabReference
+from .catalog import CacheCatalog
+from .memcache import MemoryCache
 from ..util.filelock import FileLock
 
 try:
@@ -14,10 +18,21 @@ try:
 except ImportError:
     HAVE_COCHLEA = False
 
-_cache_version = 2
+_cache_version = 3
 _cache_path = os.path.join(os.path.dirname(__file__), 'cache')
-_index_file = os.path.join(_cache_path, 'index.pk')
-_index = None
+_catalogs = {}  # CacheCatalog instances by filename
+_shards = {}  # SpikeShard instances by filename
+
+# Maximum size of the cache in bytes (None for no limit); see set_cache_budget()
+_cache_budget = None
+# Access times in the catalog are only updated when older than this (seconds)
+_atime_resolution = 60.
+# Minimum interval between automatic garbage collections (seconds)
+_gc_interval = 60.
+_last_gc = 0
+# In-process LRU store of recently used spike trains, keyed by 
+# (shard filename, fiber key); see set_memory_cache_size()
+_memory_cache = MemoryCache(0)
 
 
 def get_spiketrain(cf, sr, stim, seed, **kwds):
@@ -35,40 +50,166 @@ def get_spiketrain(cf, sr, stim, seed, **kwds):
     is little chance the cache would be re-used.
     
     """
-    filename = get_cache_filename(cf=cf, sr=sr, seed=seed, stim=stim, **kwds)
-    subdir = os.path.dirname(filename)
+    return get_spiketrains([cf], [sr], [seed], stim, **kwds)[0]
+
+
+def get_spiketrains(cfs, srs, seeds, stim, **kwds):
+    """ Return a list of spike time arrays, one for each fiber described by
+    *cfs*, *srs* and *seeds*, in response to the same stimulus.
+    
+    This is the batched equivalent of calling get_spiketrain() once per fiber;
+    both functions read and write the same cache entries. Only the fibers 
+    that are missing from the cache are passed (all together) to 
+    generate_spiketrains().
     
+    All spike trains for one stimulus are cached in a single shard file (see
+    get_shard()). Cached spike times are stored as integer ticks (see 
+    shard.encode_spiketrain()), and newly generated spike trains are returned
+    exactly as they will later be read from the cache.
+    
+    Recently used spike trains are also kept in memory (see 
+    set_memory_cache_size()). The returned arrays are read-only because they
+    may be shared with other callers.
+    
+    Parameters
+    ----------
+    cfs : array-like
+        Center frequency of each fiber
+    srs : array-like or int
+        Spontaneous rate group of each fiber (see generate_spiketrain())
+    seeds : array-like or int
+        Random seed for each fiber
+    stim : Sound instance
+        Stimulus sound presented to all fibers
+    **kwds : 
+        Extra arguments passed to generate_spiketrain() (see that function).
+        
+    The --ignore-an-cache and --no-an-cache flags are handled as in 
+    get_spiketrain().
+    """
+    cfs, srs, seeds = np.broadcast_arrays(cfs, srs, seeds)
+    cfs = cfs.ravel()
+    srs = srs.ravel()
+    seeds = seeds.ravel()
+    
+    if '--no-an-cache' in sys.argv:
+        return generate_spiketrains(cfs, srs, stim, seeds, **kwds)
+    
+    stim_key = make_key(**stim.key())
+    shard = get_shard(stim)
+    catalog = get_catalog()
+    keys = [get_fiber_key(cf=cfs[i], sr=srs[i], seed=seeds[i], **kwds) 
+            for i in range(len(cfs))]
+    trains = [None] * len(cfs)
+    if '--ignore-an-cache' not in sys.argv:
+        trains = [_memory_cache.get((shard.filename, key)) for key in keys]
+        todo = [i for i in range(len(keys)) if trains[i] is None]
+        cataloged = catalog.lookup(stim_key, [keys[i] for i in todo])
+        hits = [i for i in todo if keys[i] in cataloged]
+        for i, data in zip(hits, _read_shard(shard, [keys[i] for i in hits])):
+            trains[i] = data
+        stale = time.time() - _atime_resolution
+        stale = [keys[i] for i in hits if trains[i] is not None and cataloged[keys[i]] < stale]
+        if len(stale) > 0:
+            catalog.touch(stim_key, stale)
+        # Fibers present in the shard but not in the catalog (eg. after the 
+        # catalog was deleted) are registered rather than regenerated.
+        found = [i for i in range(len(keys)) 
+                 if trains[i] is None and keys[i] in shard]
+        for i, data in zip(found, _read_shard(shard, [keys[i] for i in found])):
+            trains[i] = data
+        found = [i for i in found if trains[i] is not None]
+        _register(catalog, stim_key, shard, [keys[i] for i in found], 
+                  cfs[found], srs[found], seeds[found], kwds.get('simulator'))
+        for i in todo:
+            if trains[i] is not None:
+                _memory_cache.put((shard.filename, keys[i]), trains[i])
+
+    missing = [i for i in range(len(cfs)) if trains[i] is None]
+    if len(missing) == 0:
+        logging.info("Loaded %d AN spike trains from cache: %s", len(keys), 
+                     shard.filename)
+        return trains
+    
+    logging.info("Generate %d new AN spike trains (%d cached): %s", 
+                 len(missing), len(cfs) - len(missing), shard.filename)
+    new_trains = generate_spiketrains(cfs[missing], srs[missing], stim, 
+                                      seeds[missing], **kwds)
+    with FileLock(shard.filename):
+        append = {}
+        for i, data in zip(missing, new_trains):
+            # Another process may have generated this fiber while we were
+            # busy; prefer the cached copy so that all callers agree.
+            if '--ignore-an-cache' in sys.argv or keys[i] not in shard:
+                append[keys[i]] = data
+        shard.append(append, dt=stim.dt)
+    for i in missing:
+        trains[i] = shard.get(keys[i])
+        _memory_cache.put((shard.filename, keys[i]), trains[i])
+    _register(catalog, stim_key, shard, [keys[i] for i in missing], 
+              cfs[missing], srs[missing], seeds[missing], kwds.get('simulator'))
+    _check_budget()
+    return trains
+
+
+def get_misses(cfs, srs, seeds, stim, **kwds):
+    """ Return the indexes of the fibers described by *cfs*, *srs* and *seeds*
+    (broadcast together as in get_spiketrains()) that are not yet cached for 
+    *stim*.
+    
+    This consults only the cache catalog, so batch callers can cheaply 
+    decide which fibers to generate together.
+    """
+    cfs, srs, seeds = np.broadcast_arrays(cfs, srs, seeds)
+    cfs = cfs.ravel()
+    srs = srs.ravel()
+    seeds = seeds.ravel()
+    keys = [get_fiber_key(cf=cfs[i], sr=srs[i], seed=seeds[i], **kwds) 
+            for i in range(len(cfs))]
+    cataloged = get_catalog().lookup(make_key(**stim.key()), keys)
+    return [i for i in range(len(keys)) if keys[i] not in cataloged]
+
+
+def _register(catalog, stim_key, shard, keys, cfs, srs, seeds, simulator, ctime=None):
+    """ Add cached fibers to the catalog.
+    """
+    if len(keys) == 0:
+        return
+    shard_name = os.path.relpath(shard.filename, os.path.dirname(catalog.filename))
+    entries = [(keys[i], cfs[i], srs[i], seeds[i], simulator, shard.nbytes(keys[i]))
+               for i in range(len(keys))]
+    catalog.add(stim_key, shard_name, entries, ctime=ctime)
+
+
+def _make_cache_dir(filename):
+    subdir = os.path.dirname(filename)
     if not os.path.exists(subdir):
         try:
-            os.mkdir(subdir)
+            os.makedirs(subdir)
         except OSError as err:
             # probably another process already created this directory
             # since we last checked
             pass
-    
-    with FileLock(filename):
-        
-        if '--ignore-an-cache' in sys.argv or '--no-an-cache' in sys.argv or not os.path.exists(filename):
-            create = True
-        else:
-            create = False
-            # try loading cached data
-            try:
-                data = np.load(open(filename, 'rb'))['data']
-                logging.info("Loaded AN spike train from cache: %s", filename)
-            except Exception:
-                create = True
-                sys.excepthook(*sys.exc_info())
-                logging.error("Error reading AN spike train cache file; will "
-                    "re-generate. File: %s", filename)
 
-        if create:
-            logging.info("Generate new AN spike train: %s", filename)
-            data = generate_spiketrain(cf, sr, stim, seed, **kwds)
-            if '--no-an-cache' not in sys.argv:
-                np.savez_compressed(filename, data=data)
-            
-    return data
+
+def _read_shard(shard, keys):
+    """ Return a list of the spike trains for *keys* stored in *shard* (None 
+    for missing keys). 
+    
+    If the shard cannot be read, it is moved aside so that its contents will 
+    be regenerated.
+    """
+    try:
+        return [shard.get(key) for key in keys]
+    except Exception:
+        sys.excepthook(*sys.exc_info())
+        logging.error("Error reading AN spike train cache file; will "
+            "re-generate. File: %s", shard.filename)
+        with FileLock(shard.filename):
+            if os.path.exists(shard.filename):
+                os.rename(shard.filename, shard.filename + '.bad')
+        _shards.pop(shard.filename, None)
+        return [None] * len(keys)
 
 
 def make_key(**kwds):
@@ -86,12 +227,416 @@ def make_key(**kwds):
     return '_'.join(['%s=%s' % kv for kv in kwds])
 
 
-def get_cache_filename(cf, sr, seed, stim, **kwds):
-    global _cache_path
-    subdir = os.path.join(_cache_path, make_key(**stim.key()))
-    filename = make_key(cf=cf, sr=sr, seed=seed, **kwds)
-    filename = os.path.join(subdir, filename) + '.npz'
-    return filename
+def get_stim_hash(stim_key):
+    """ Return a short, filesystem-safe name for the stimulus key string 
+    *stim_key* (as returned by ``make_key(**stim.key())``).
+    """
+    if not isinstance(stim_key, bytes):
+        stim_key = stim_key.encode('utf-8')
+    return hashlib.sha1(stim_key).hexdigest()
+
+
+def get_fiber_key(cf, sr, seed, **kwds):
+    """ Return the key that identifies a single fiber within a shard.
+    """
+    return make_key(cf=cf, sr=sr, seed=seed, **kwds)
+
+
+def get_shard_filename(stim):
+    """ Return the name of the shard file that caches all spike trains
+    generated in response to *stim*.
+    """
+    stim_hash = get_stim_hash(make_key(**stim.key()))
+    return os.path.join(_cache_path, 'shards', stim_hash + '.shard')
+
+
+def get_shard(stim):
+    """ Return the SpikeShard holding all cached spike trains for *stim*.
+    """
+    filename = get_shard_filename(stim)
+    if filename not in _shards:
+        _make_cache_dir(filename)
+        _shards[filename] = SpikeShard(filename, stim_key=make_key(**stim.key()))
+    return _shards[filename]
+
+
+def get_catalog(path=None):
+    """ Return the CacheCatalog for the cache at *path* (default: the 
+    current cache path).
+    """
+    filename = os.path.join(_cache_path if path is None else path, 'catalog.sqlite')
+    if filename not in _catalogs:
+        _catalogs[filename] = CacheCatalog(filename)
+    return _catalogs[filename]
+
+
+def parse_fiber_key(key):
+    """ Return (cf, sr, seed, simulator) parsed from a fiber key (see 
+    get_fiber_key()). Values that cannot be parsed are None.
+    """
+    vals = []
+    for name, typ in (('cf', float), ('sr', int), ('seed', int), ('simulator', str)):
+        m = re.search(r'(?:^|_)%s=([^_]+)' % name, key)
+        try:
+            val = typ(m.group(1))
+        except (AttributeError, ValueError):
+            val = None
+        vals.append(None if val == 'None' else val)
+    return tuple(vals)
+
+
+def rebuild_catalog(path=None):
+    """ Rebuild the cache catalog from the shard files under *path* (default:
+    the current cache path). Returns the number of fibers cataloged.
+    
+    Access times are reset to the modification time of each shard.
+    """
+    if path is None:
+        path = _cache_path
+    catalog = get_catalog(path)
+    catalog.clear()
+    shard_dir = os.path.join(path, 'shards')
+    if not os.path.isdir(shard_dir):
+        return 0
+    count = 0
+    for f in sorted(os.listdir(shard_dir)):
+        if not f.endswith('.shard'):
+            continue
+        filename = os.path.join(shard_dir, f)
+        shard = SpikeShard(filename)
+        keys = shard.keys()
+        params = [parse_fiber_key(k) for k in keys]
+        entries = [(k, p[0], p[1], p[2], p[3], shard.nbytes(k)) 
+                   for k, p in zip(keys, params)]
+        catalog.add(shard.stim_key, os.path.join('shards', f), entries, 
+                    ctime=os.stat(filename).st_mtime)
+        count += len(keys)
+    return count
+
+
+def set_memory_cache_size(size):
+    """ Set the maximum number of bytes of spike trains kept in memory by this
+    process (see parse_size()); 0 disables the memory cache.
+    
+    The initial size is read from the CNMODEL_AN_MEMORY_CACHE environment 
+    variable (default 256M).
+    """
+    _memory_cache.resize(parse_size(size))
+
+
+def memory_cache_stats():
+    """ Return a dict of statistics for the in-memory spike train cache: 
+    entries, nbytes, max_bytes, hits, misses and evictions.
+    """
+    return _memory_cache.stats()
+
+
+def clear_memory_cache():
+    """ Remove all spike trains from the in-memory cache and reset its 
+    counters.
+    """
+    _memory_cache.clear()
+
+
+def parse_size(size):
+    """ Convert a size such as 2048, '500M' or '20G' to a number of bytes. 
+    Returns None if *size* is None.
+    """
+    if size is None or isinstance(size, (int, np.integer)):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def set_cache_budget(size):
+    """ Limit the size of the AN cache to *size* bytes (see parse_size()). 
+    
+    When new spike trains are cached and the cache exceeds this budget, the
+    least recently used stimuli are evicted (see collect_garbage()). Use None
+    to disable the limit. The initial budget is read from the 
+    CNMODEL_AN_CACHE_BUDGET environment variable.
+    """
+    global _cache_budget
+    _cache_budget = parse_size(size)
+
+set_cache_budget(os.environ.get('CNMODEL_AN_CACHE_BUDGET'))
+set_memory_cache_size(os.environ.get('CNMODEL_AN_MEMORY_CACHE', '256M'))
+
+
+def _resolve_stim_key(stim, path=None):
+    # Accept a Sound, a stimulus key, or a unique prefix of a stimulus hash
+    if hasattr(stim, 'key'):
+        return make_key(**stim.key())
+    catalog = get_catalog(path)
+    keys = [st['stim_key'] for st in catalog.stimuli()] + list(catalog.pinned().keys())
+    if stim in keys:
+        return stim
+    matches = set(k for k in keys if get_stim_hash(k).startswith(stim))
+    if len(matches) == 1:
+        return matches.pop()
+    if len(matches) > 1:
+        raise ValueError("Ambiguous stimulus hash prefix: %s" % stim)
+    # assume this is the key of a stimulus that has not been cached yet
+    return stim
+
+
+def pin_stimulus(stim, label=None, path=None):
+    """ Protect all spike trains cached for *stim* from eviction.
+    
+    *stim* may be a Sound instance, a stimulus key (as shown by 
+    ``python -m cnmodel.an_model.cache report``) or a unique prefix of the
+    stimulus hash (the shard file name). Pinning a stimulus that is not yet
+    cached protects it once it is.
+    """
+    get_catalog(path).pin(_resolve_stim_key(stim, path), label)
+
+
+def unpin_stimulus(stim, path=None):
+    """ Allow the spike trains cached for *stim* to be evicted again. See
+    pin_stimulus().
+    """
+    get_catalog(path).unpin(_resolve_stim_key(stim, path))
+
+
+def get_cache_usage(path=None):
+    """ Return a list of dicts describing the disk usage of each stimulus in 
+    the cache, ordered from least to most recently used.
+    
+    Each dict has the keys stim_hash, stim_key, atime, pinned and nbytes (the
+    size of the shard and IHC files). Shard and IHC files that are not in the
+    catalog are included with the key None and the file modification time.
+    """
+    if path is None:
+        path = _cache_path
+    catalog = get_catalog(path)
+    pinned = set(get_stim_hash(k) for k in catalog.pinned())
+    usage = {}
+    for st in catalog.stimuli():
+        h = get_stim_hash(st['stim_key'])
+        usage[h] = {'stim_hash': h, 'stim_key': st['stim_key'], 'atime': st['atime'], 
+                    'pinned': h in pinned, 'nbytes': 0}
+    for subdir in ('shards', 'ihc'):
+        base = os.path.join(path, subdir)
+        if not os.path.isdir(base):
+            continue
+        for name in os.listdir(base):
+            fname = os.path.join(base, name)
+            if subdir == 'shards':
+                if not name.endswith('.shard'):
+                    continue
+                h = name[:-6]
+                files = [fname]
+            else:
+                h = name
+                files = [os.path.join(fname, f) for f in os.listdir(fname)]
+            try:
+                stats = [os.stat(f) for f in files]
+            except OSError:
+                continue  # removed while we were looking
+            if h not in usage:
+                mtime = max([s.st_mtime for s in stats] or [0])
+                usage[h] = {'stim_hash': h, 'stim_key': None, 'atime': mtime, 
+                            'pinned': h in pinned, 'nbytes': 0}
+            usage[h]['nbytes'] += sum(s.st_size for s in stats)
+    return sorted(usage.values(), key=lambda u: u['atime'])
+
+
+def collect_garbage(budget=None, path=None, dry_run=False):
+    """ Evict the least recently used stimuli from the cache until its size
+    is within *budget* bytes (default is the current cache budget; see 
+    set_cache_budget()). 
+    
+    A stimulus is the unit of eviction: its shard file, IHC files and catalog
+    entries are removed together. Pinned stimuli (see pin_stimulus()) are 
+    never evicted. If *dry_run* is True, nothing is removed.
+    
+    Returns the list of evicted stimuli, as described by get_cache_usage().
+    """
+    if path is None:
+        path = _cache_path
+    budget = _cache_budget if budget is None else parse_size(budget)
+    if budget is None:
+        raise ValueError("No cache budget specified.")
+    usage = get_cache_usage(path)
+    total = sum(u['nbytes'] for u in usage)
+    evicted = []
+    for u in usage:
+        if total <= budget:
+            break
+        if u['pinned']:
+            continue
+        if not dry_run:
+            _evict(path, u)
+        evicted.append(u)
+        total -= u['nbytes']
+    if total > budget:
+        logging.warning("AN cache size (%d bytes) exceeds budget (%d bytes) after "
+                        "evicting all unpinned stimuli.", total, budget)
+    return evicted
+
+
+def _evict(path, usage):
+    shard_file = os.path.join(path, 'shards', usage['stim_hash'] + '.shard')
+    logging.info("Evict from AN cache: %s", usage['stim_key'] or shard_file)
+    with FileLock(shard_file):
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+        shutil.rmtree(os.path.join(path, 'ihc', usage['stim_hash']), ignore_errors=True)
+        if usage['stim_key'] is not None:
+            get_catalog(path).remove(usage['stim_key'])
+    _shards.pop(shard_file, None)
+    _memory_cache.discard(lambda key: key[0] == shard_file)
+
+
+def _check_budget():
+    # Collect garbage if the cache budget is set, at most once per _gc_interval
+    global _last_gc
+    if _cache_budget is None or time.time() - _last_gc < _gc_interval:
+        return
+    _last_gc = time.time()
+    collect_garbage()
+
+
+def migrate_npz_cache(path=None, remove=False):
+    """ Convert a cache tree of per-fiber .npz files (cache version 2) into 
+    shard files. 
+    
+    Each stimulus directory under *path* (default: the current cache path)
+    becomes one shard; fibers already present in the shard are skipped. If 
+    *remove* is True, the .npz files and emptied directories are deleted 
+    after conversion. Returns the number of spike trains converted.
+    """
+    if path is None:
+        path = _cache_path
+    catalog = get_catalog(path)
+    count = 0
+    for stim_key in sorted(os.listdir(path)):
+        subdir = os.path.join(path, stim_key)
+        if stim_key in ('shards', 'ihc') or not os.path.isdir(subdir):
+            continue
+        files = [f for f in os.listdir(subdir) if f.endswith('.npz')]
+        if len(files) == 0:
+            continue
+        rate = re.search(r'(?:^|_)rate=([^_]+)', stim_key)
+        try:
+            dt = 1.0 / float(rate.group(1))
+        except (AttributeError, ValueError):
+            dt = None
+        filename = os.path.join(path, 'shards', get_stim_hash(stim_key) + '.shard')
+        _make_cache_dir(filename)
+        shard = SpikeShard(filename, stim_key=stim_key)
+        trains = {}
+        for f in files:
+            key = f[:-4]
+            if key in shard:
+                continue
+            try:
+                trains[key] = np.load(os.path.join(subdir, f))['data']
+            except Exception:
+                logging.error("Skipping unreadable cache file: %s", os.path.join(subdir, f))
+        with FileLock(filename):
+            shard.append(trains, dt=dt)
+        keys = list(trains.keys())
+        params = [parse_fiber_key(k) for k in keys]
+        catalog.add(stim_key, os.path.join('shards', os.path.basename(filename)),
+                    [(k, p[0], p[1], p[2], p[3], shard.nbytes(k)) 
+                     for k, p in zip(keys, params)])
+        count += len(trains)
+        logging.info("Migrated %d spike trains to %s", len(trains), filename)
+        if remove:
+            for f in os.listdir(subdir):
+                if f.endswith('.npz') or f.endswith('.npz.lock'):
+                    os.remove(os.path.join(subdir, f))
+            if len(os.listdir(subdir)) == 0:
+                os.rmdir(subdir)
+    return count
+
+
+def get_ihc_cache_filename(cf, stim, **kwds):
+    """ Return the name of the file used to cache the IHC potential for *cf* 
+    and *stim*. Keyword arguments are the model_ihc() options other than 
+    *pin*, *CF* and *tdres* (which are determined by *cf* and *stim*).
+    """
+    subdir = os.path.join(_cache_path, 'ihc', get_stim_hash(make_key(**stim.key())))
+    filename = make_key(cf=cf, **kwds)
+    return os.path.join(subdir, filename) + '.npy'
+
+
+def get_ihc(cf, stim, pin=None, matlab=None, **kwds):
+    """ Return the IHC potential computed by model_ihc() in response to 
+    *stim* as a float32 array.
+    
+    The IHC stage depends only on the stimulus, CF and the model_ihc() 
+    options (nrep, reptime, cohc, cihc, species); it does not depend on the
+    random seed or the spontaneous rate group of a fiber. The waveform is
+    therefore cached in its own file (see get_ihc_cache_filename()) and reused
+    by every fiber with the same CF, regardless of seed or SR group. The 
+    --ignore-an-cache and --no-an-cache flags are handled as in 
+    get_spiketrain().
+    
+    Parameters
+    ----------
+    cf : float
+        Center frequency of the IHC
+    stim : Sound instance
+        Stimulus sound
+    pin : MatlabReference or None
+        Optional reference to *stim.sound* already uploaded to MATLAB (see 
+        wrapper.upload()); this is only used if the IHC must be computed.
+    matlab : MatlabProcess or None
+        The MATLAB process used if the IHC must be computed (default is 
+        get_matlab()). *pin* must belong to the same process.
+    **kwds : 
+        Options passed to model_ihc().
+    """
+    ihc_kwds = dict(nrep=1, reptime=stim.duration*2, cohc=1, cihc=1, species=1)
+    ihc_kwds.update(kwds)
+    filename = get_ihc_cache_filename(cf, stim, **ihc_kwds)
+    use_cache = '--no-an-cache' not in sys.argv
+    if use_cache and '--ignore-an-cache' not in sys.argv:
+        _make_cache_dir(filename)
+        with FileLock(filename, shared=True):
+            vihc = _read_ihc_file(filename)
+        if vihc is not None:
+            return vihc
+    
+    if use_cache:
+        _make_cache_dir(filename)
+        lock = FileLock(filename)
+        lock.acquire()
+    try:
+        if use_cache and '--ignore-an-cache' not in sys.argv:
+            # generated by another process while we waited for the lock?
+            vihc = _read_ihc_file(filename)
+            if vihc is not None:
+                return vihc
+        
+        logging.info("Generate new IHC potential: %s", filename)
+        if pin is None:
+            pin = stim.sound
+        vihc = model_ihc(pin, CF=cf, tdres=stim.dt, matlab=matlab, **ihc_kwds)
+        vihc = np.asarray(vihc, dtype=np.float32).ravel()
+        if use_cache:
+            np.save(filename, vihc)
+        return vihc
+    finally:
+        if use_cache:
+            lock.release()
+
+
+def _read_ihc_file(filename):
+    if not os.path.exists(filename):
+        return None
+    try:
+        return np.load(filename)
+    except Exception:
+        sys.excepthook(*sys.exc_info())
+        logging.error("Error reading IHC cache file; will re-generate. "
+                      "File: %s", filename)
+        return None
 
 
 def generate_spiketrain(cf, sr, stim, seed, simulator=None, **kwds):
@@ -118,16 +663,38 @@ def generate_spiketrain(cf, sr, stim, seed, simulator=None, **kwds):
         'cihc', and 'implnt'. 
         'simulator' is used to set the simulator ('matlab' or 'cochlea')
     """
+    return generate_spiketrains([cf], [sr], stim, [seed], simulator=simulator, **kwds)[0]
+
+
+def generate_spiketrains(cfs, srs, stim, seeds, simulator=None, **kwds):
+    """ Generate new spike trains for a group of fibers that all receive the 
+    same stimulus. Returns a list of arrays of spike times in seconds, one per
+    fiber.
+    
+    Each returned spike train is identical to the result of calling 
+    generate_spiketrain() with the same cf, sr and seed. Arguments are as 
+    described in generate_spiketrain(), except that *cfs*, *srs* and *seeds*
+    are sequences of equal length.
     
+    With the MATLAB simulator, the IHC stage is taken from get_ihc() once for
+    each unique CF in the batch; the seed only affects the synapse stage. The
+    stimulus is transferred to MATLAB at most once. If more than one MATLAB
+    worker is configured (see wrapper.set_matlab_workers()), the IHC and 
+    synapse stages are distributed over a MatlabPool; every fiber seeds the
+    RNG of its worker before its synapse stage runs, so the results do not
+    depend on the number of workers. The cochlea simulator
+    does not expose its IHC stage and seeds a single random stream per call,
+    so each fiber is still run separately to keep its spike train 
+    independent of the other fibers in the batch.
+    """
     for k in ['pin', 'CF', 'fiberType', 'noiseType']:
         if k in kwds:
             raise TypeError("Argument '%s' is not allowed here." % k)
     
-    ihc_kwds = dict(pin=stim.sound, CF=cf, nrep=1, tdres=stim.dt, 
-                    reptime=stim.duration*2, cohc=1, cihc=1, species=1)
-    syn_kwds = dict(CF=cf, nrep=1, tdres=stim.dt, fiberType=sr, noiseType=1, implnt=0)
+    ihc_kwds = dict(nrep=1, reptime=stim.duration*2, cohc=1, cihc=1, species=1)
+    syn_kwds = dict(nrep=1, tdres=stim.dt, noiseType=1, implnt=0)
     # copy any given keyword args to the correct model function
-    for kwd in kwds:
+    for kwd in list(kwds.keys()):
         if kwd in ihc_kwds:
             ihc_kwds[kwd] = kwds.pop(kwd)
         if kwd in syn_kwds:
@@ -140,28 +707,84 @@ def generate_spiketrain(cf, sr, stim, seed, simulator=None, **kwds):
         raise TypeError("Invalid keyword arguments: %s" % list(kwds.keys()))
     
     if simulator == 'matlab':
-        seed_rng(seed)
-        vihc = model_ihc(_transfer=False, **ihc_kwds) 
-        m, v, psth = model_synapse(vihc, _transfer=False, **syn_kwds)
-        psth = psth.get().ravel()
-        times = np.argwhere(psth).ravel()
-        return times * stim.dt
+        pool = get_matlab_pool()
+        ucfs = []
+        for cf in cfs:
+            if cf not in ucfs:
+                ucfs.append(cf)
+        if pool is None:
+            ml = get_matlab()
+            pin = None
+            vihc = {}
+            for cf in ucfs:
+                ihc_file = get_ihc_cache_filename(cf, stim, **ihc_kwds)
+                if pin is None and (not os.path.exists(ihc_file) or 
+                                    '--ignore-an-cache' in sys.argv or
+                                    '--no-an-cache' in sys.argv):
+                    # IHC must be computed; upload the stimulus just once
+                    pin = upload(stim.sound.reshape(1, stim.sound.size))
+                ihc = get_ihc(cf, stim, pin=pin, **ihc_kwds)
+                vihc[cf] = upload(ihc.astype(np.float64).reshape(1, ihc.size))
+            return [_matlab_synapse(ml, stim, cf, vihc[cf], [sr], [seed], syn_kwds)[0]
+                    for cf, sr, seed in zip(cfs, srs, seeds)]
+        
+        # IHC potentials first (one task per CF), then the synapse model for
+        # chunks of fibers; each fiber seeds the RNG of the worker that runs it.
+        vihc = pool.map(_matlab_ihc, [stim] * len(ucfs), ucfs, [ihc_kwds] * len(ucfs))
+        vihc = dict(zip(ucfs, vihc))
+        chunk = max(1, int(np.ceil(len(cfs) / float(len(pool)))))
+        tasks = []
+        for cf in ucfs:
+            inds = [i for i in range(len(cfs)) if cfs[i] == cf]
+            tasks.extend([inds[i:i+chunk] for i in range(0, len(inds), chunk)])
+        futures = [pool.submit(_matlab_synapse, stim, cfs[g[0]], vihc[cfs[g[0]]], 
+                               [srs[j] for j in g], [seeds[j] for j in g], syn_kwds)
+                   for g in tasks]
+        trains = [None] * len(cfs)
+        for group, fut in zip(tasks, futures):
+            for j, train in zip(group, fut.result()):
+                trains[j] = train
+        return trains
     elif simulator == 'cochlea' and HAVE_COCHLEA:
         fs = int(0.5+1./stim.dt)  # need to avoid roundoff error
-        srgrp = [0,0,0] # H, M, L (but input is 1=L, 2=M, H = 3)
-        srgrp[2-sr] = 1
-        sp = cochlea.run_zilany2014(
-                stim.sound,
-                fs=fs,
-                anf_num=srgrp,
-                cf=cf,
-                seed=seed,
-                species='cat')
-        return np.array(sp.spikes.values[0])
+        trains = []
+        for cf, sr, seed in zip(cfs, srs, seeds):
+            srgrp = [0,0,0] # H, M, L (but input is 1=L, 2=M, H = 3)
+            srgrp[2-sr] = 1
+            sp = cochlea.run_zilany2014(
+                    stim.sound,
+                    fs=fs,
+                    anf_num=srgrp,
+                    cf=cf,
+                    seed=seed,
+                    species='cat')
+            trains.append(np.array(sp.spikes.values[0]))
+        return trains
     else:  # it remains possible to have a typo.... 
         raise ValueError("anmodel/cache.py: Simulator must be specified as either MATLAB or cochlea; found %s" % simulator)
 
 
+def _matlab_ihc(matlab, stim, cf, ihc_kwds):
+    # Return the IHC potential for *cf*, computed (if needed) by *matlab*
+    return get_ihc(cf, stim, matlab=matlab, **ihc_kwds)
+
+
+def _matlab_synapse(matlab, stim, cf, ihc, srs, seeds, syn_kwds):
+    # Return spike trains for fibers at *cf*, given the IHC potential *ihc*
+    # (array or MatlabReference).
+    if not isinstance(ihc, MatlabReference):
+        ihc = upload(ihc.astype(np.float64).reshape(1, ihc.size), matlab=matlab)
+    trains = []
+    for sr, seed in zip(srs, seeds):
+        seed_rng(seed, matlab=matlab)
+        m, v, psth = model_synapse(ihc, CF=cf, fiberType=sr, matlab=matlab,
+                                   _transfer=False, **syn_kwds)
+        psth = psth.get().ravel()
+        times = np.argwhere(psth).ravel()
+        trains.append(times * stim.dt)
+    return trains
+
+
 def detect_simulator():
     """Return the name of any available auditory periphery model.
     
@@ -176,3 +799,74 @@ def detect_simulator():
         get_matlab()
         simulator = 'matlab'
     return simulator
+
+
+def print_report(path=None):
+    """ Print a summary of the cache contents, one line per stimulus.
+    """
+    stims = get_catalog(path).stimuli()
+    total = 0
+    print("%8s %12s  %-19s  %-19s %3s  %s" % ('fibers', 'bytes', 'created', 'accessed', 
+                                              'pin', 'stimulus'))
+    for st in stims:
+        print("%8d %12d  %s  %s %3s  %s" % (st['n_fibers'], st['nbytes'], 
+            _format_time(st['ctime']), _format_time(st['atime']), 
+            '*' if st['pinned'] else '', st['stim_key']))
+        total += st['nbytes']
+    print("%d stimuli, %d fibers, %d bytes" % (len(stims), sum(st['n_fibers'] for st in stims), total))
+
+
+def _format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m cnmodel.an_model.cache',
+                                     description="Maintenance of the AN spike train cache.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--path', default=None, help="Cache directory (default: %s)" % _cache_path)
+    sub = parser.add_subparsers(dest='command')
+    mig = sub.add_parser('migrate', parents=[common], 
+                         help="Convert per-fiber .npz cache files into shards.")
+    mig.add_argument('--remove', action='store_true', help="Delete .npz files after conversion.")
+    sub.add_parser('report', parents=[common], help="Summarize cache contents by stimulus.")
+    sub.add_parser('rebuild', parents=[common], help="Rebuild the catalog from the shard files.")
+    gc = sub.add_parser('gc', parents=[common], 
+                        help="Evict least recently used stimuli to fit the cache budget.")
+    gc.add_argument('--budget', default=None, 
+                    help="Maximum cache size, eg. 500M or 20G (default: $CNMODEL_AN_CACHE_BUDGET).")
+    gc.add_argument('--dry-run', action='store_true', help="Only list what would be evicted.")
+    pin = sub.add_parser('pin', parents=[common], help="Protect a stimulus from eviction.")
+    pin.add_argument('stim', help="Stimulus key or unique prefix of its hash.")
+    pin.add_argument('--label', default=None, help="Note describing the pinned stimulus.")
+    unpin = sub.add_parser('unpin', parents=[common], help="Allow a stimulus to be evicted.")
+    unpin.add_argument('stim', help="Stimulus key or unique prefix of its hash.")
+    args = parser.parse_args(argv)
+    
+    if args.command == 'migrate':
+        n = migrate_npz_cache(args.path, remove=args.remove)
+        print("Migrated %d spike trains." % n)
+    elif args.command == 'report':
+        print_report(args.path)
+    elif args.command == 'rebuild':
+        n = rebuild_catalog(args.path)
+        print("Cataloged %d spike trains." % n)
+    elif args.command == 'gc':
+        budget = args.budget if args.budget is not None else _cache_budget
+        if budget is None:
+            parser.error("no budget given (use --budget or set CNMODEL_AN_CACHE_BUDGET)")
+        evicted = collect_garbage(budget, args.path, dry_run=args.dry_run)
+        for u in evicted:
+            print("%s %12d  %s" % ('would evict' if args.dry_run else 'evicted', 
+                                   u['nbytes'], u['stim_key'] or u['stim_hash']))
+        print("%d stimuli, %d bytes" % (len(evicted), sum(u['nbytes'] for u in evicted)))
+    elif args.command == 'pin':
+        pin_stimulus(args.stim, args.label, args.path)
+    elif args.command == 'unpin':
+        unpin_stimulus(args.stim, args.path)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+SQLite catalog of the spike trains held in the AN model cache.
+
+The catalog records one row per cached fiber: the stimulus key, the fiber
+parameters (cf, sr, seed, simulator), the number of bytes used in the shard,
+and the creation and last-access times. It answers hit/miss questions for
+many fibers with a single indexed query, and lets tools summarize the cache
+contents without walking the cache directory.
+
+Stimuli may be pinned so that they are never evicted by
+cache.collect_garbage().
+
+The shard files remain the authoritative store of spike data; the catalog can
+always be rebuilt from them (see cache.rebuild_catalog()).
+"""
+
+import os, time, sqlite3
+
+_schema = """
+CREATE TABLE IF NOT EXISTS spiketrains (
+    stim_key  TEXT NOT NULL,
+    fiber_key TEXT NOT NULL,
+    shard     TEXT NOT NULL,
+    cf        REAL,
+    sr        INTEGER,
+    seed      INTEGER,
+    simulator TEXT,
+    nbytes    INTEGER NOT NULL,
+    ctime     REAL NOT NULL,
+    atime     REAL NOT NULL,
+    PRIMARY KEY (stim_key, fiber_key)
+);
+CREATE INDEX IF NOT EXISTS spiketrains_atime ON spiketrains (atime);
+CREATE TABLE IF NOT EXISTS pinned (
+    stim_key  TEXT PRIMARY KEY,
+    label     TEXT,
+    ctime     REAL NOT NULL
+);
+"""
+
+# stay well below SQLITE_MAX_VARIABLE_NUMBER (999 by default)
+_max_vars = 500
+
+
+class CacheCatalog(object):
+    """ Index of the fibers stored in an AN spike train cache.
+
+    The database connection is opened on first use and re-opened in child
+    processes after a fork. Concurrent writers are serialized by SQLite
+    itself.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SQLite database file. Created if it does not exist.
+    timeout : float
+        Seconds to wait for another process to release the database.
+    """
+    def __init__(self, filename, timeout=60.):
+        self.filename = filename
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            subdir = os.path.dirname(self.filename)
+            if not os.path.isdir(subdir):
+                try:
+                    os.makedirs(subdir)
+                except OSError:
+                    pass
+            conn = sqlite3.connect(self.filename, timeout=self.timeout)
+            conn.executescript(_schema)
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def lookup(self, stim_key, fiber_keys):
+        """ Return a dict {fiber_key: atime} for each of *fiber_keys* that is 
+        cataloged for *stim_key*.
+        """
+        fiber_keys = list(fiber_keys)
+        found = {}
+        for i in range(0, len(fiber_keys), _max_vars):
+            chunk = fiber_keys[i:i+_max_vars]
+            query = ("SELECT fiber_key, atime FROM spiketrains WHERE stim_key=? "
+                     "AND fiber_key IN (%s)" % ','.join('?' * len(chunk)))
+            found.update(self.conn.execute(query, [stim_key] + chunk))
+        return found
+
+    def add(self, stim_key, shard, entries, ctime=None):
+        """ Record newly cached fibers.
+
+        Parameters
+        ----------
+        stim_key : str
+            Stimulus key (see cache.make_key())
+        shard : str
+            Shard file name, relative to the cache directory
+        entries : list
+            One tuple (fiber_key, cf, sr, seed, simulator, nbytes) per fiber.
+            Existing rows for the same fibers are replaced.
+        ctime : float or None
+            Creation time to record (default is now).
+        """
+        if ctime is None:
+            ctime = time.time()
+        rows = [(stim_key, fk, shard, _float(cf), _int(sr), _int(seed),
+                 None if sim is None else str(sim), int(nbytes), ctime, ctime)
+                for fk, cf, sr, seed, sim, nbytes in entries]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO spiketrains VALUES "
+                                  "(?,?,?,?,?,?,?,?,?,?)", rows)
+
+    def touch(self, stim_key, fiber_keys, atime=None):
+        """ Set the last-access time of the given fibers (default is now).
+        """
+        if atime is None:
+            atime = time.time()
+        with self.conn:
+            self.conn.executemany("UPDATE spiketrains SET atime=? WHERE "
+                                  "stim_key=? AND fiber_key=?",
+                                  [(atime, stim_key, fk) for fk in fiber_keys])
+
+    def remove(self, stim_key, fiber_keys=None):
+        """ Remove fibers from the catalog. If *fiber_keys* is None, all
+        fibers for *stim_key* are removed.
+        """
+        with self.conn:
+            if fiber_keys is None:
+                self.conn.execute("DELETE FROM spiketrains WHERE stim_key=?", (stim_key,))
+            else:
+                self.conn.executemany("DELETE FROM spiketrains WHERE stim_key=? "
+                                      "AND fiber_key=?",
+                                      [(stim_key, fk) for fk in fiber_keys])
+
+    def pin(self, stim_key, label=None):
+        """ Protect all fibers of *stim_key* from eviction.
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pinned VALUES (?,?,?)", 
+                              (stim_key, label, time.time()))
+
+    def unpin(self, stim_key):
+        """ Allow *stim_key* to be evicted again.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM pinned WHERE stim_key=?", (stim_key,))
+
+    def pinned(self):
+        """ Return a dict {stim_key: label} of all pinned stimuli.
+        """
+        return dict(self.conn.execute("SELECT stim_key, label FROM pinned"))
+
+    def clear(self):
+        """ Remove all entries (but not the pins) from the catalog.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM spiketrains")
+
+    def entries(self, stim_key=None):
+        """ Return a list of dicts describing every cataloged fiber (or only
+        those for *stim_key*).
+        """
+        query = "SELECT * FROM spiketrains"
+        args = ()
+        if stim_key is not None:
+            query += " WHERE stim_key=?"
+            args = (stim_key,)
+        return self._dicts(self.conn.execute(query + " ORDER BY stim_key, fiber_key", args))
+
+    def stimuli(self):
+        """ Return a list of dicts summarizing the cache contents by stimulus,
+        with keys stim_key, shard, n_fibers, nbytes, ctime (oldest entry), 
+        atime (most recent access) and pinned (1 if the stimulus is pinned).
+        """
+        cur = self.conn.execute(
+            "SELECT s.stim_key AS stim_key, shard, COUNT(*) AS n_fibers, "
+            "SUM(nbytes) AS nbytes, MIN(s.ctime) AS ctime, MAX(atime) AS atime, "
+            "p.stim_key IS NOT NULL AS pinned FROM spiketrains s "
+            "LEFT JOIN pinned p ON s.stim_key = p.stim_key "
+            "GROUP BY s.stim_key, shard ORDER BY s.stim_key")
+        return self._dicts(cur)
+
+    @staticmethod
+    def _dicts(cur):
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur]
+
+
+def _float(x):
+    return None if x is None else float(x)
+
+
+def _int(x):
+    return None if x is None else int(x)
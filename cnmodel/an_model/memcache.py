@@ -0,0 +1,94 @@
+"""
+In-process, size-limited LRU store of recently used spike trains.
+
+Protocols that repeat the same stimulus many times request the same spike
+trains over and over; this store returns them without touching the catalog
+or the shard files. Arrays are marked read-only when they are stored, so the
+same array can safely be handed to every caller.
+"""
+
+from collections import OrderedDict
+
+
+class MemoryCache(object):
+    """ Least-recently-used mapping of keys to numpy arrays, limited by the
+    total number of bytes held.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size (in bytes) of the stored arrays. Use 0 to disable
+        the cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the array stored for *key* (marking it most recently used),
+        or None.
+        """
+        try:
+            arr = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = arr
+        self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        """ Store *arr* for *key*, evicting the least recently used arrays as
+        needed. *arr* is made read-only.
+        """
+        arr.flags.writeable = False
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        if arr.nbytes > self.max_bytes:
+            return
+        self._data[key] = arr
+        self.nbytes += arr.nbytes
+        self._trim()
+
+    def discard(self, match):
+        """ Remove all keys for which ``match(key)`` is True.
+        """
+        for key in [k for k in self._data if match(k)]:
+            self.nbytes -= self._data.pop(key).nbytes
+
+    def resize(self, max_bytes):
+        """ Change the size limit, evicting arrays if needed.
+        """
+        self.max_bytes = max_bytes
+        self._trim()
+
+    def clear(self):
+        """ Remove all arrays and reset the counters.
+        """
+        self._data.clear()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """ Return a dict with the number of entries, bytes held, the size
+        limit and the hit, miss and eviction counts.
+        """
+        return {'entries': len(self._data), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def _trim(self):
+        while self.nbytes > self.max_bytes and len(self._data) > 0:
+            key, arr = self._data.popitem(last=False)
+            self.nbytes -= arr.nbytes
+            self.evictions += 1
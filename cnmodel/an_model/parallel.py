@@ -0,0 +1,105 @@
+"""
+Generate AN spike trains for many fibers in a pool of worker processes.
+
+Workers receive the stimulus once, when the pool starts; each task then
+carries only a chunk of (cf, sr, seed) values and the stimulus key. Spike
+trains are generated and cached by the workers exactly as get_spiketrains()
+would in a single process, so the results are identical to a serial run.
+"""
+
+import sys, logging, multiprocessing
+import numpy as np
+from .cache import get_spiketrains, get_misses, make_key
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    HAVE_FUTURES = True
+except ImportError:
+    HAVE_FUTURES = False
+
+
+_worker_stims = {}  # stimuli available to this worker process, by key
+
+
+def _init_worker(stim):
+    _worker_stims[make_key(**stim.key())] = stim
+
+
+def _run_chunk(args):
+    stim_key, cfs, srs, seeds, kwds = args
+    return get_spiketrains(cfs, srs, seeds, _worker_stims[stim_key], **kwds)
+
+
+def get_spiketrains_parallel(cfs, srs, seeds, stim, workers=None, chunksize=None, **kwds):
+    """ Return a list of spike time arrays as get_spiketrains() does,
+    generating any uncached spike trains in a pool of worker processes.
+
+    Fibers that are already cached are read directly by the calling process;
+    only the remaining fibers are divided into chunks and sent to the
+    workers. No pool is started if nothing needs to be generated.
+
+    Parameters
+    ----------
+    cfs, srs, seeds, stim :
+        See get_spiketrains().
+    workers : int or None
+        Number of worker processes (default is the number of CPUs).
+    chunksize : int or None
+        Number of fibers sent to a worker at a time (default divides the
+        fibers into about four chunks per worker).
+    **kwds :
+        Extra arguments passed to get_spiketrains().
+    """
+    cfs, srs, seeds = np.broadcast_arrays(cfs, srs, seeds)
+    cfs = cfs.ravel()
+    srs = srs.ravel()
+    seeds = seeds.ravel()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if '--no-an-cache' in sys.argv or '--ignore-an-cache' in sys.argv:
+        todo = list(range(len(cfs)))
+    else:
+        todo = get_misses(cfs, srs, seeds, stim, **kwds)
+    trains = [None] * len(cfs)
+    missing = set(todo)
+    done = [i for i in range(len(cfs)) if i not in missing]
+    if len(done) > 0:
+        for i, train in zip(done, get_spiketrains(cfs[done], srs[done], seeds[done], stim, **kwds)):
+            trains[i] = train
+    if len(todo) == 0:
+        return trains
+
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(len(todo) / (4. * workers))))
+    chunks = [todo[i:i+chunksize] for i in range(0, len(todo), chunksize)]
+    workers = min(workers, len(chunks))
+    if workers < 2:
+        results = [get_spiketrains(cfs[todo], srs[todo], seeds[todo], stim, **kwds)]
+        chunks = [todo]
+    else:
+        stim_key = make_key(**stim.key())
+        tasks = [(stim_key, cfs[c], srs[c], seeds[c], kwds) for c in chunks]
+        logging.info("Generating %d AN spike trains in %d chunks on %d workers..",
+                     len(todo), len(chunks), workers)
+        results = _map(_run_chunk, tasks, workers, stim)
+    for chunk, result in zip(chunks, results):
+        for i, train in zip(chunk, result):
+            trains[i] = train
+    return trains
+
+
+def _map(func, tasks, workers, stim):
+    # Run *func* over *tasks* with workers initialized for *stim*.
+    # ProcessPoolExecutor only supports an initializer in python >= 3.7;
+    # otherwise fall back to multiprocessing.Pool.
+    if HAVE_FUTURES and sys.version_info >= (3, 7):
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(stim,)) as executor:
+            return list(executor.map(func, tasks))
+    pool = multiprocessing.Pool(workers, _init_worker, (stim,))
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
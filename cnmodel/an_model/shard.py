@@ -0,0 +1,268 @@
+"""
+Compact on-disk storage for many AN spike trains evoked by a single stimulus.
+
+A shard file holds the spike trains of every fiber (cf, sr, seed, ...) that
+has been generated for one stimulus. Spike times are stored as delta-encoded
+int32 tick counts in a CSR layout (a fiber table of offsets/counts plus one
+contiguous data block), so any single fiber can be decoded from a read-only
+memory map without loading the rest of the file.
+
+File layout (all integers little-endian)::
+
+    file header:   magic 'CNMSHRD1', int64 n, n bytes of stimulus key
+                   (utf-8, zero-padded to a multiple of 8 bytes)
+    segment 0:     segment header, fiber table, data
+    segment 1:     ...
+
+Each segment is written by a single append() call:
+
+    segment header: magic 'CNMSEG01', int64 n_fibers, int64 key_size,
+                    int64 n_data, float64 tick
+    fiber table:    n_fibers records of (key: S<key_size>, offset: int64,
+                    count: int64)
+    data:           n_data int32 deltas (zero-padded to a multiple of 8 bytes)
+
+Fiber *i* of a segment has spike times
+``cumsum(data[offset:offset+count]) * tick``. When a key appears in more than
+one segment, the last segment wins. A segment that extends past the end of
+the file (for example, after a crash during an append) is ignored and is
+truncated by the next append.
+"""
+
+import os, struct
+import numpy as np
+
+_file_magic = b'CNMSHRD1'
+_seg_magic = b'CNMSEG01'
+_file_header = struct.Struct('<8sq')
+_seg_header = struct.Struct('<8sqqqd')
+_max_delta = 2**31 - 1
+
+
+class ShardError(Exception):
+    pass
+
+
+def _pad8(n):
+    return (n + 7) // 8 * 8
+
+
+def encode_spiketrain(times, dt=None):
+    """ Return (deltas, tick) encoding the spike *times* (seconds) as int32
+    tick deltas.
+
+    If all spike times are integer multiples of the sample period *dt*, the
+    tick is *dt* and the encoding is exact. Otherwise a finer tick is chosen
+    (at most dt/1000) so that spike times are preserved to a small fraction
+    of the sample period.
+    """
+    times = np.asarray(times, dtype=np.float64).ravel()
+    if dt is None:
+        dt = 1e-5
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int32), dt
+    samples = times / dt
+    ticks = np.round(samples)
+    if np.all(np.abs(samples - ticks) < 1e-6):
+        tick = dt
+    else:
+        div = 1000
+        span = max(times[-1], np.diff(times).max() if len(times) > 1 else 0) / dt
+        while div > 1 and span * div >= _max_delta:
+            div //= 10
+        tick = dt / div
+        ticks = np.round(times / tick)
+    ticks = ticks.astype(np.int64)
+    deltas = np.diff(ticks)
+    if len(ticks) > 0 and (ticks[0] < 0 or np.any(deltas < 0)):
+        raise ValueError("Spike times must be non-negative and sorted.")
+    if ticks[0] > _max_delta or (len(deltas) > 0 and deltas.max() > _max_delta):
+        raise ValueError("Spike train cannot be encoded with int32 deltas.")
+    return np.concatenate([ticks[:1], deltas]).astype(np.int32), tick
+
+
+def decode_spiketrain(deltas, tick):
+    """ Return spike times (seconds) from int32 tick *deltas*.
+    """
+    return np.cumsum(deltas, dtype=np.int64) * tick
+
+
+class SpikeShard(object):
+    """ Spike trains for all fibers that have been generated for a single
+    stimulus, stored in one file.
+
+    Reading is lock-free: appends only add complete segments to the end of the
+    file, and the index is refreshed incrementally whenever the file grows.
+    Callers must hold a lock on the file (see util.filelock) while calling
+    append().
+
+    Parameters
+    ----------
+    filename : str
+        Path to the shard file. The file is created by the first append().
+    stim_key : str or None
+        Stimulus key stored in the file header when the file is created.
+    """
+    def __init__(self, filename, stim_key=None):
+        self.filename = filename
+        self._stim_key = stim_key
+        self._index = {}      # key: (data_start, offset, count, tick)
+        self._scan_pos = 0    # end of the last complete segment scanned
+        self._scan_size = 0   # file size at the last scan
+        self._scan_ino = None
+        self._mmap = None
+        self._mmap_size = 0
+
+    @property
+    def stim_key(self):
+        """ The stimulus key recorded in the file header.
+        """
+        self.scan()
+        return self._stim_key
+
+    def keys(self):
+        """ Return a list of the fiber keys stored in this shard.
+        """
+        self.scan()
+        return list(self._index.keys())
+
+    def __contains__(self, key):
+        self.scan()
+        return key in self._index
+
+    def __len__(self):
+        self.scan()
+        return len(self._index)
+
+    def nbytes(self, key):
+        """ Return the number of data bytes used by *key*.
+        """
+        self.scan()
+        return self._index[key][2] * 4
+
+    def get(self, key):
+        """ Return the spike times (seconds) stored for fiber *key*, or None
+        if the key is not present.
+        """
+        if key not in self._index:
+            self.scan()
+            if key not in self._index:
+                return None
+        start, offset, count, tick = self._index[key]
+        mm = self._map(start + (offset + count) * 4)
+        deltas = mm[start + offset*4:start + (offset+count)*4].view('<i4')
+        return decode_spiketrain(deltas, tick)
+
+    def append(self, trains, dt=None):
+        """ Append a new segment containing *trains*, a dict of
+        {fiber_key: spike_times}. Returns nothing.
+
+        The caller must hold an exclusive lock on this shard file.
+        """
+        if len(trains) == 0:
+            return
+        self.scan()
+        keys = sorted(trains.keys())
+        encoded = [encode_spiketrain(trains[k], dt) for k in keys]
+        # one tick for the whole segment
+        tick = min([e[1] for e in encoded])
+        if any(e[1] != tick for e in encoded):
+            encoded = [encode_spiketrain(decode_spiketrain(*e), tick) for e in encoded]
+            if any(e[1] != tick for e in encoded):
+                raise ShardError("Could not encode segment with a common tick.")
+        counts = np.array([len(e[0]) for e in encoded], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        bkeys = [k.encode('utf-8') for k in keys]
+        key_size = _pad8(max(len(k) for k in bkeys))  # keeps the data 8-byte aligned
+        table = np.empty(len(keys), dtype=self._table_dtype(key_size))
+        table['key'] = bkeys
+        table['offset'] = offsets
+        table['count'] = counts
+        data = np.concatenate([e[0] for e in encoded]).astype('<i4')
+
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        with open(self.filename, 'ab') as fh:
+            if self._scan_pos == 0:
+                # new (or unreadable) file; write the file header first
+                fh.truncate(0)
+                fh.write(self._make_file_header())
+            elif size > self._scan_pos:
+                # drop a partial segment left behind by an interrupted append
+                fh.truncate(self._scan_pos)
+            fh.write(_seg_header.pack(_seg_magic, len(keys), key_size, len(data), tick))
+            fh.write(table.tobytes())
+            raw = data.tobytes()
+            fh.write(raw)
+            fh.write(b'\0' * (_pad8(len(raw)) - len(raw)))
+        self.scan()
+
+    def scan(self):
+        """ Read any segments appended since the last scan and update the
+        index.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            # not yet created, or removed (eg. evicted from the cache)
+            self._index = {}
+            self._scan_pos = 0
+            self._scan_size = 0
+            self._scan_ino = None
+            self._mmap = None
+            return
+        size = st.st_size
+        if st.st_ino != self._scan_ino or size < self._scan_size:
+            # new, replaced or truncated file; start over
+            self._index = {}
+            self._scan_pos = 0
+            self._scan_size = 0
+            self._scan_ino = st.st_ino
+            self._mmap = None
+        if size == self._scan_size:
+            return
+        with open(self.filename, 'rb') as fh:
+            pos = self._scan_pos
+            if pos == 0:
+                head = fh.read(_file_header.size)
+                if len(head) < _file_header.size:
+                    return
+                magic, n = _file_header.unpack(head)
+                if magic != _file_magic:
+                    raise ShardError("Not a spike shard file: %s" % self.filename)
+                key = fh.read(_pad8(n))
+                if len(key) < _pad8(n):
+                    return
+                self._stim_key = key[:n].decode('utf-8')
+                pos = fh.tell()
+            while pos + _seg_header.size <= size:
+                fh.seek(pos)
+                magic, n_fibers, key_size, n_data, tick = _seg_header.unpack(fh.read(_seg_header.size))
+                if magic != _seg_magic:
+                    raise ShardError("Corrupt segment at byte %d in %s" % (pos, self.filename))
+                dtype = self._table_dtype(key_size)
+                table_start = pos + _seg_header.size
+                data_start = table_start + n_fibers * dtype.itemsize
+                end = data_start + _pad8(n_data * 4)
+                if end > size:
+                    break  # incomplete segment
+                table = np.frombuffer(fh.read(n_fibers * dtype.itemsize), dtype=dtype)
+                for rec in table:
+                    key = rec['key'].decode('utf-8')
+                    self._index[key] = (data_start, int(rec['offset']), int(rec['count']), tick)
+                pos = end
+        self._scan_pos = pos
+        self._scan_size = size
+
+    def _map(self, end):
+        if self._mmap is None or self._mmap_size < end:
+            self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+            self._mmap_size = len(self._mmap)
+        return self._mmap
+
+    def _make_file_header(self):
+        key = (self._stim_key or '').encode('utf-8')
+        return _file_header.pack(_file_magic, len(key)) + key + b'\0' * (_pad8(len(key)) - len(key))
+
+    @staticmethod
+    def _table_dtype(key_size):
+        return np.dtype([('key', 'S%d' % key_size), ('offset', '<i8'), ('count', '<i8')])
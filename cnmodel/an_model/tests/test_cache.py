@@ -1,5 +1,7 @@
-import os, tempfile
+import os, sys, tempfile
 from multiprocessing import Pool
+import numpy as np
+import pytest
 import cnmodel.an_model.cache as cache
 import cnmodel.util.sound as sound
 from cnmodel import an_model
@@ -18,9 +20,9 @@ def run_sim(*args):
                          ramp_duration=0.002, pip_duration=0.004, 
                          pip_start=[0.001])
     spikes = an_model.get_spiketrain(cf=cf, sr=sr, seed=seed, stim=stim)
-    cf = cache.get_cache_filename(cf, sr, seed, stim)
-    mtime = os.stat(cf).st_mtime
-    return cf, mtime, spikes
+    cfile = cache.get_shard_filename(stim)
+    mtime = os.stat(cfile).st_mtime
+    return cfile, mtime, spikes
 
 
 def test_cache():
@@ -32,6 +34,211 @@ def test_cache():
     assert all(spikes1 == spikes2)
 
 
+def test_batch():
+    # Batched requests must agree with (and share cache entries with) 
+    # single-fiber requests.
+    new_cache()
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    cfs = [1000, 1000, 2000]
+    srs = [2, 1, 2]
+    seeds = [1, 2, 3]
+    single = an_model.get_spiketrain(cf=cfs[1], sr=srs[1], seed=seeds[1], stim=stim)
+    batch = an_model.get_spiketrains(cfs=cfs, srs=srs, seeds=seeds, stim=stim)
+    assert len(batch) == 3
+    assert all(batch[1] == single)
+    shard = cache.get_shard(stim)
+    for i in range(3):
+        assert cache.get_fiber_key(cfs[i], srs[i], seeds[i]) in shard
+        spikes = an_model.get_spiketrain(cf=cfs[i], sr=srs[i], seed=seeds[i], stim=stim)
+        assert all(spikes == batch[i])
+
+
+def test_catalog():
+    new_cache()
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    cfs = [1000, 2000, 4000]
+    assert an_model.get_misses(cfs, 2, [1, 2, 3], stim) == [0, 1, 2]
+    an_model.get_spiketrains(cfs=cfs[:2], srs=2, seeds=[1, 2], stim=stim)
+    assert an_model.get_misses(cfs, 2, [1, 2, 3], stim) == [2]
+    
+    catalog = cache.get_catalog()
+    entries = catalog.entries(cache.make_key(**stim.key()))
+    assert [(e['cf'], e['sr'], e['seed']) for e in entries] == [(1000, 2, 1), (2000, 2, 2)]
+    stims = catalog.stimuli()
+    assert len(stims) == 1
+    assert stims[0]['n_fibers'] == 2
+    assert stims[0]['nbytes'] == sum(e['nbytes'] for e in entries)
+    
+    # the catalog can be rebuilt from the shards
+    os.remove(catalog.filename)
+    catalog.close()
+    assert cache.rebuild_catalog() == 2
+    assert an_model.get_misses(cfs, 2, [1, 2, 3], stim) == [2]
+
+
+def test_gc():
+    new_cache()
+    stims = [sound.TonePip(rate=100e3, duration=0.01, f0=f0, dbspl=80,
+                           ramp_duration=0.002, pip_duration=0.004, 
+                           pip_start=[0.001]) for f0 in (1000, 2000, 4000, 8000)]
+    for i, stim in enumerate(stims):
+        an_model.get_spiketrains(cfs=[1000, 2000], srs=2, seeds=[1, 2], stim=stim)
+        # make stims[0] the least recently used
+        cache.get_catalog().touch(cache.make_key(**stim.key()), 
+                                  [cache.get_fiber_key(cf, 2, seed) for cf, seed in ((1000, 1), (2000, 2))], 
+                                  atime=1000. + i)
+    cache.pin_stimulus(stims[1], label='golden')
+    usage = cache.get_cache_usage()
+    assert [u['stim_key'] for u in usage] == [cache.make_key(**s.key()) for s in stims]
+    sizes = [u['nbytes'] for u in usage]
+    
+    # evict the oldest unpinned stimuli until two remain
+    evicted = cache.collect_garbage(budget=sizes[1] + sizes[3])
+    assert [u['stim_key'] for u in evicted] == [usage[0]['stim_key'], usage[2]['stim_key']]
+    assert not os.path.exists(cache.get_shard_filename(stims[0]))
+    assert os.path.exists(cache.get_shard_filename(stims[1]))
+    assert an_model.get_misses(1000, 2, 1, stims[0]) == [0]
+    assert an_model.get_misses(1000, 2, 1, stims[1]) == []
+    
+    # evicted stimuli are regenerated on demand
+    spikes = an_model.get_spiketrain(cf=1000, sr=2, seed=1, stim=stims[0])
+    assert an_model.get_misses(1000, 2, 1, stims[0]) == []
+    assert cache.parse_size('1.5K') == 1536
+
+
+def test_memory_cache():
+    new_cache()
+    cache.clear_memory_cache()
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    spikes1 = an_model.get_spiketrain(cf=1000, sr=2, seed=1, stim=stim)
+    spikes2 = an_model.get_spiketrain(cf=1000, sr=2, seed=1, stim=stim)
+    assert spikes2 is spikes1
+    assert not spikes1.flags.writeable
+    with pytest.raises(ValueError):
+        spikes1[:] = 0
+    stats = cache.memory_cache_stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['entries'] == 1
+    
+    # arrays are evicted to respect the size limit
+    cache.set_memory_cache_size(spikes1.nbytes)
+    an_model.get_spiketrain(cf=1000, sr=2, seed=2, stim=stim)
+    stats = cache.memory_cache_stats()
+    assert stats['entries'] <= 1 and stats['evictions'] >= 1
+    assert stats['nbytes'] <= spikes1.nbytes
+    cache.set_memory_cache_size('256M')
+
+
+def test_ihc_cache():
+    new_cache()
+    try:
+        an_model.get_matlab()
+    except RuntimeError:
+        pytest.skip("MATLAB unavailable")
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    ihc1 = cache.get_ihc(1000, stim)
+    ifile = cache.get_ihc_cache_filename(1000, stim, nrep=1, reptime=0.02, 
+                                         cohc=1, cihc=1, species=1)
+    mtime = os.stat(ifile).st_mtime
+    assert ihc1.dtype == np.float32
+    # all seeds and SR groups at this CF reuse the cached IHC potential
+    an_model.get_spiketrains(cfs=1000, srs=[0, 1, 2], seeds=[1, 2, 3], 
+                             stim=stim, simulator='matlab')
+    assert os.stat(ifile).st_mtime == mtime
+    assert np.all(cache.get_ihc(1000, stim) == ihc1)
+
+
+def test_migrate():
+    # Spike trains cached as per-fiber .npz files (cache version 2) are 
+    # converted into a shard and read back unchanged.
+    new_cache()
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    subdir = os.path.join(cache._cache_path, cache.make_key(**stim.key()))
+    os.makedirs(subdir)
+    trains = {}
+    for seed in range(3):
+        trains[seed] = np.sort(np.random.randint(0, 1000, size=20)) * stim.dt
+        key = cache.get_fiber_key(1000, 2, seed)
+        np.savez_compressed(os.path.join(subdir, key + '.npz'), data=trains[seed])
+    assert cache.migrate_npz_cache(remove=True) == 3
+    assert not os.path.exists(subdir)
+    for seed in range(3):
+        spikes = an_model.get_spiketrain(cf=1000, sr=2, seed=seed, stim=stim)
+        assert np.allclose(spikes, trains[seed], rtol=0, atol=1e-12)
+
+
+def test_pool():
+    # Spike trains generated by a process pool are identical to the serial 
+    # path, regardless of chunking.
+    from cnmodel.an_model.parallel import get_spiketrains_parallel
+    stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                         ramp_duration=0.002, pip_duration=0.004, 
+                         pip_start=[0.001])
+    cfs = [1000, 2000, 4000, 1000, 2000, 4000, 8000]
+    seeds = np.arange(len(cfs)) + 100
+    new_cache()
+    serial = an_model.get_spiketrains(cfs=cfs, srs=2, seeds=seeds, stim=stim)
+    new_cache()
+    cache.clear_memory_cache()
+    # one fiber already cached; the rest are generated by the workers
+    an_model.get_spiketrain(cf=cfs[0], sr=2, seed=seeds[0], stim=stim)
+    pool = get_spiketrains_parallel(cfs, 2, seeds, stim, workers=2, chunksize=2)
+    assert len(pool) == len(serial)
+    for a, b in zip(serial, pool):
+        assert a.dtype == b.dtype and np.all(a == b)
+    assert an_model.get_misses(cfs, 2, seeds, stim) == []
+
+
+def stub_matlab():
+    # Return an executable that runs util/tests/matlab_stub.py in place of MATLAB
+    import cnmodel.util
+    stub = os.path.join(os.path.dirname(cnmodel.util.__file__), 'tests', 'matlab_stub.py')
+    exe = os.path.join(tempfile.mkdtemp(), 'matlab')
+    with open(exe, 'w') as fh:
+        fh.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, stub))
+    os.chmod(exe, 0o755)
+    return exe
+
+
+def test_matlab_pool():
+    # Spike trains generated on a pool of MATLAB workers are identical to 
+    # those from a single MATLAB process.
+    from cnmodel.an_model import wrapper
+    from cnmodel.util.matlab_proc import MatlabProcess
+    exe = stub_matlab()
+    orig_proc = wrapper._proc
+    wrapper._proc = MatlabProcess(executable=exe)
+    try:
+        stim = sound.TonePip(rate=100e3, duration=0.01, f0=4000, dbspl=80,
+                             ramp_duration=0.002, pip_duration=0.004, 
+                             pip_start=[0.001])
+        cfs = [1000, 2000, 1000, 4000, 2000, 1000, 1000]
+        srs = [1, 2, 3, 1, 2, 3, 3]
+        seeds = [5, 6, 7, 8, 9, 10, 11]
+        new_cache()
+        serial = cache.generate_spiketrains(cfs, srs, stim, seeds, simulator='matlab')
+        wrapper.set_matlab_workers(3, executable=exe)
+        new_cache()
+        pooled = cache.generate_spiketrains(cfs, srs, stim, seeds, simulator='matlab')
+        assert len(wrapper.get_matlab_pool()) == 3
+        for a, b in zip(serial, pooled):
+            assert np.all(a == b)
+        assert not np.all(serial[5] == serial[6])
+    finally:
+        wrapper.set_matlab_workers(1)
+        wrapper._proc.close()
+        wrapper._proc = orig_proc
+
+
 def test_parallel():
     # Make sure file locking works correctly.
     new_cache()  # note that subprocesses will all inherit this new cache 
@@ -3,32 +3,73 @@ import numpy as np
 from ..util import matlab_proc
 
 _proc = None
+_pool = None
+# Number of MATLAB processes used to generate spike trains; see set_matlab_workers()
+_pool_size = int(os.environ.get('CNMODEL_MATLAB_WORKERS', 1))
+_pool_args = {}
+_model_path = os.path.join(os.path.dirname(__file__), 'model')
 
 def get_matlab():
     """ Return a running MatlabProcess instance.
     """
     global _proc
     if _proc is None:
-        path = os.path.dirname(__file__)
-        model_path = os.path.join(path, 'model')
-        _proc = matlab_proc.MatlabProcess(cwd=model_path)
-        # Try building the model mex files 
-        if _proc.exist('model_IHC') == 0:
-            print "\nCompiling MEX for auditory periphery model..."
-            try:
-                _proc('mexANmodel;')
-            except Exception as err:
-                print err.output
-                print ""
-                raise RuntimeError(
-                    "An error occurred while compiling the auditory periphery model.\n" +
-                    "The complete output is printed above. " +
-                    "See cnmodel/an_model/model/readme.txt for more information.")
-            print "Done."
+        _proc = matlab_proc.MatlabProcess(cwd=_model_path)
+        _compile_mex(_proc)
     return _proc
 
 
-def model_ihc(pin, CF, nrep=1, tdres=1e-5, reptime=1, cohc=1, cihc=1, species=1, **kwds):
+def _compile_mex(proc):
+    # Try building the model mex files 
+    if proc.exist('model_IHC') == 0:
+        print "\nCompiling MEX for auditory periphery model..."
+        try:
+            proc('mexANmodel;')
+        except Exception as err:
+            print err.output
+            print ""
+            raise RuntimeError(
+                "An error occurred while compiling the auditory periphery model.\n" +
+                "The complete output is printed above. " +
+                "See cnmodel/an_model/model/readme.txt for more information.")
+        print "Done."
+
+
+def set_matlab_workers(n, **kwds):
+    """ Set the number of MATLAB processes used to generate spike trains.
+    
+    With more than one worker, generate_spiketrains() dispatches the model to
+    a MatlabPool (see get_matlab_pool()). The initial value is read from the 
+    CNMODEL_MATLAB_WORKERS environment variable (default 1). Extra keyword
+    arguments are passed to MatlabPool (eg. executable).
+    """
+    global _pool_size, _pool_args, _pool
+    n = int(n)
+    if _pool is not None and (n != _pool_size or kwds != _pool_args):
+        _pool.close()
+        _pool = None
+    _pool_size = n
+    _pool_args = kwds
+
+
+def get_matlab_pool():
+    """ Return a running MatlabPool with the number of workers set by 
+    set_matlab_workers(), or None if fewer than two workers are requested.
+    
+    The model MEX files are compiled (if necessary) by the first worker 
+    before the others are started.
+    """
+    global _pool
+    if _pool_size < 2:
+        return None
+    if _pool is None:
+        kwds = dict(cwd=_model_path)
+        kwds.update(_pool_args)
+        _pool = matlab_proc.MatlabPool(_pool_size, setup=_compile_mex, **kwds)
+    return _pool
+
+
+def model_ihc(pin, CF, nrep=1, tdres=1e-5, reptime=1, cohc=1, cihc=1, species=1, matlab=None, **kwds):
     """
     Return the output of model_IHC() from the AN model
     (Zilany, Bruce, Ibrahim and Carney, 2014; requires MATLAB)
@@ -38,7 +79,7 @@ def model_ihc(pin, CF, nrep=1, tdres=1e-5, reptime=1, cohc=1, cihc=1, species=1,
     
     Parameters
     ----------
-    pin : array
+    pin : array or MatlabReference
         The input sound wave in Pa sampled at the rate specified by *tdres*
     CF : float
         The characteristic frequency of the IHC in Hz
@@ -59,9 +100,13 @@ def model_ihc(pin, CF, nrep=1, tdres=1e-5, reptime=1, cohc=1, cihc=1, species=1,
         The model species: "1" for cat, "2" for human with BM tuning from 
         Shera et al. (PNAS 2002), or "3" for human BM tuning from 
         Glasberg & Moore (Hear. Res. 1990)
+    matlab : MatlabProcess or None
+        The MATLAB process to run the model in (default is get_matlab()).
     """
-    # make sure pin is a row vector
-    pin = pin.reshape(1, pin.size)
+    # make sure pin is a row vector (unless it is a reference to a matlab variable)
+    if isinstance(pin, np.ndarray):
+        pin = pin.reshape(1, pin.size)
+        assert reptime >= pin.size * tdres
     
     # convert all args to double, as required by model_IHC
     args = [pin]
@@ -69,16 +114,14 @@ def model_ihc(pin, CF, nrep=1, tdres=1e-5, reptime=1, cohc=1, cihc=1, species=1,
         if not isinstance(arg, matlab_proc.MatlabReference):
             arg = float(arg)
         args.append(arg)
-        
-    assert reptime >= pin.size * tdres
     
-    ml = get_matlab()
+    ml = get_matlab() if matlab is None else matlab
     fn = ml.model_IHC
     fn.nargout = 1  # necessary because nargout(model_IHC) fails
     return fn(*args, **kwds)
 
 
-def model_synapse(vihc, CF, nrep=1, tdres=1e-5, fiberType=0, noiseType=1, implnt=1, **kwds):
+def model_synapse(vihc, CF, nrep=1, tdres=1e-5, fiberType=0, noiseType=1, implnt=1, matlab=None, **kwds):
     """
     Return the output of model_Synapse() from the AN model
     (Zilany, Bruce, Ibrahim and Carney, 2014; requires MATLAB)
@@ -109,6 +152,8 @@ def model_synapse(vihc, CF, nrep=1, tdres=1e-5, fiberType=0, noiseType=1, implnt
     implnt : 0 or 1
         "Approxiate" or "actual" implementation of the power-law functions: 
         "0" for approx. and "1" for actual implementation
+    matlab : MatlabProcess or None
+        The MATLAB process to run the model in (default is get_matlab()).
     """
     # make sure vihc is a row vector (unless it is a reference to a matlab variable)
     if isinstance(vihc, np.ndarray):
@@ -121,17 +166,35 @@ def model_synapse(vihc, CF, nrep=1, tdres=1e-5, fiberType=0, noiseType=1, implnt
             arg = float(arg)
         args.append(arg)
     
-    ml = get_matlab()
+    ml = get_matlab() if matlab is None else matlab
     fn = ml.model_Synapse
     fn.nargout = 3  # necessary because nargout(model_IHC) fails
     return fn(*args, **kwds)
     
 
-def seed_rng(seed):
+def upload(data, matlab=None):
+    """ Transfer *data* to a new variable in the MATLAB workspace and return
+    a MatlabReference to it. 
+    
+    The reference may be passed to model_ihc() or model_synapse() in place of
+    an array to avoid transferring the same data more than once. The MATLAB
+    variable is cleared when the reference is deleted.
+    
+    *matlab* is the MATLAB process to upload to (default is get_matlab()).
+    """
+    ml = get_matlab() if matlab is None else matlab
+    ref = ml._mkref('cnm_upload_%d' % np.random.randint(1e12))
+    setattr(ml, ref.name, data)
+    return ref
+
+
+def seed_rng(seed, matlab=None):
     """
     Seed the random number generator used by model_ihc and model_synapse. 
+    
+    *matlab* is the MATLAB process to seed (default is get_matlab()).
     """
     seed = int(seed)
     cmd = "RandStream.setGlobalStream(RandStream('mcg16807','seed',%d));" % seed
-    ml = get_matlab()
+    ml = get_matlab() if matlab is None else matlab
     ml(cmd)
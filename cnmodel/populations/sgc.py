@@ -1,9 +1,9 @@
 import logging
 import numpy as np
-import pyqtgraph.multiprocess as mp
 
 from .population import Population
 from .. import cells
+from .. import an_model
 
 
 class SGC(Population):
@@ -43,23 +43,38 @@ class SGC(Population):
         # SGC does not support any inputs
         assert len(self.connections) == 0
 
-    def set_sound_stim(self, stim, parallel=False):
+    def set_sound_stim(self, stim, parallel=False, workers=None, chunksize=None):
         """Set a sound stimulus to generate spike trains for all (real) cells
         in this population.
+        
+        Each cell is assigned the next seed from the population's seed 
+        sequence (see set_seed()), in order of cell index, so the spike 
+        trains do not depend on how they are generated.
+        
+        Parameters
+        ----------
+        stim : Sound instance
+            The stimulus presented to all cells.
+        parallel : bool or str
+            If False, all spike trains are requested from the AN model / cache
+            in a single batch. If True (or 'process'), uncached spike trains are
+            generated in a pool of worker processes (see 
+            an_model.parallel.get_spiketrains_parallel()). 'pyqtgraph' uses 
+            pyqtgraph.multiprocess (requires Qt).
+        workers : int or None
+            Number of worker processes (default is the number of CPUs).
+        chunksize : int or None
+            Number of cells sent to a worker process at a time.
         """
         real = self.real_cells()
         logging.info("Assigning spike trains to %d SGC cells..", len(real))
-        if not parallel:
-            for i, ind in enumerate(real):
-                logging.info("Assigning spike train to SGC %d (%d/%d)", ind, i, len(real))
-                cell = self.get_cell(ind)
-                cell.set_sound_stim(stim, self.next_seed)
-                self.next_seed += 1
-                
-        else:
-            seeds = range(self.next_seed, self.next_seed + len(real))
-            self.next_seed = seeds[-1] + 1
-            tasks = zip(seeds, real)
+        seeds = np.arange(self.next_seed, self.next_seed + len(real))
+        self.next_seed += len(real)
+        cells = [self.get_cell(ind) for ind in real]
+        
+        if parallel == 'pyqtgraph':
+            import pyqtgraph.multiprocess as mp
+            tasks = list(zip(seeds, real))
             trains = [None] * len(tasks)
             # generate spike trains in parallel
             with mp.Parallelize(enumerate(tasks), trains=trains, progressDialog='Generating SGC spike trains..') as tasker:
@@ -69,7 +84,18 @@ class SGC(Population):
                     train = cell.generate_spiketrain(stim, seed)
                     tasker.trains[i] = train
             # collected all trains; now assign to cells
-            for i,ind in enumerate(real):
-                cell = self.get_cell(ind)
-                cell.set_spiketrain(trains[i])
-            
\ No newline at end of file
+            for cell, train in zip(cells, trains):
+                cell.set_spiketrain(train)
+            return
+        
+        kwds = dict(cfs=[cell.cf for cell in cells], srs=[cell.sr for cell in cells],
+                    seeds=seeds, stim=stim, simulator=self._cell_args.get('simulator'))
+        if parallel:
+            from ..an_model.parallel import get_spiketrains_parallel
+            trains = get_spiketrains_parallel(workers=workers, chunksize=chunksize, **kwds)
+        else:
+            # generate all spike trains with a single batched request to the
+            # AN model / cache
+            trains = an_model.get_spiketrains(**kwds)
+        for cell, train in zip(cells, trains):
+            cell.set_spiketrain(train * 1000)
@@ -26,21 +26,32 @@
 # either expressed or implied, of the FreeBSD Project.
  
 import os
+import sys
 import time
 import errno
+import signal
+import threading
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
  
 class FileLockException(Exception):
     pass
  
-class FileLock(object):
+class PollingFileLock(object):
     """ A file locking mechanism that has context-manager support so 
         you can use it in a with statement. This should be relatively cross
         compatible as it doesn't rely on msvcrt or fcntl for the locking.
+        
+        All locks are exclusive; the *shared* argument is accepted for 
+        compatibility with FlockFileLock and ignored.
     """
     lock_count = {}  # lock count for each locked file
     lock_handles = {}  # file handle for each locked file
     
-    def __init__(self, file_name, timeout=10, delay=.05):
+    def __init__(self, file_name, timeout=10, delay=.05, shared=False):
         """ Prepare the file locker. Specify the file to lock and optionally
             the maximum timeout and the delay between each attempt to lock.
         """
@@ -59,10 +70,10 @@ class FileLock(object):
             an exception.
         """
         # Don't try to lock the same file more than once
-        if FileLock.lock_count.setdefault(self.lockfile, 0) > 0:
+        if PollingFileLock.lock_count.setdefault(self.lockfile, 0) > 0:
             self.is_locked = True
-            self.fd = FileLock.lock_handles[self.lockfile]
-            FileLock.lock_count[self.lockfile] += 1
+            self.fd = PollingFileLock.lock_handles[self.lockfile]
+            PollingFileLock.lock_count[self.lockfile] += 1
             return
         
         start_time = time.time()
@@ -91,8 +102,8 @@ class FileLock(object):
                 time.sleep(self.delay)
         
         self.is_locked = True
-        FileLock.lock_count[self.lockfile] += 1
-        FileLock.lock_handles[self.lockfile] = self.fd
+        PollingFileLock.lock_count[self.lockfile] += 1
+        PollingFileLock.lock_handles[self.lockfile] = self.fd
  
     def release(self):
         """ Get rid of the lock by deleting the lockfile. 
@@ -101,11 +112,11 @@ class FileLock(object):
         """
         if self.is_locked:
             self.is_locked = False
-            FileLock.lock_count[self.lockfile] -= 1
-            if FileLock.lock_count[self.lockfile] == 0:
+            PollingFileLock.lock_count[self.lockfile] -= 1
+            if PollingFileLock.lock_count[self.lockfile] == 0:
                 os.close(self.fd)
                 os.unlink(self.lockfile)
-                del FileLock.lock_handles[self.lockfile]
+                del PollingFileLock.lock_handles[self.lockfile]
  
     def __enter__(self):
         """ Activated when used in the with statement. 
@@ -126,4 +137,174 @@ class FileLock(object):
         """ Make sure that the FileLock instance doesn't leave a lockfile
             lying around.
         """
-        self.release()
\ No newline at end of file
+        self.release()
+
+class _LockTimeout(Exception):
+    pass
+
+
+def _alarm_handler(signum, frame):
+    raise _LockTimeout()
+
+
+class FlockFileLock(object):
+    """ A file lock based on flock(2) advisory locks, with the same interface
+        as PollingFileLock.
+        
+        Waiting processes sleep in the kernel until the lock is released 
+        instead of polling, and a lock is released automatically when its
+        holder exits or dies, so a leftover lockfile can never wedge other
+        processes. Lockfiles are removed by the last process to release them.
+        
+        Several processes may hold a shared (reader) lock on the same file;
+        an exclusive (writer) lock excludes all others. A process that 
+        already holds a shared lock is upgraded when it requests an exclusive
+        lock on the same file.
+        
+        *timeout* is the maximum time in seconds to wait for the lock (None to
+        wait forever). It is enforced with a SIGALRM interval timer, which is
+        only possible in the main thread and when no other interval timer is
+        running; otherwise the lock waits without a timeout. *delay* is 
+        accepted for compatibility and ignored.
+    """
+    lock_count = {}    # lock count for each locked file
+    lock_handles = {}  # file descriptor for each locked file
+    lock_shared = {}   # whether each locked file is held in shared mode
+    
+    def __init__(self, file_name, timeout=10, delay=.05, shared=False):
+        self.fd = None
+        self.is_locked = False
+        self.lockfile = os.path.join(os.getcwd(), "%s.lock" % file_name)
+        self.file_name = file_name
+        self.timeout = timeout
+        self.delay = delay
+        self.shared = shared
+ 
+    def acquire(self):
+        """ Acquire the lock, waiting up to `timeout` seconds. Raises 
+            FileLockException if the timeout expires.
+        """
+        cls = FlockFileLock
+        if self.timeout is None:
+            self._deadline = None
+        else:
+            self._deadline = time.time() + self.timeout
+        
+        # Don't try to lock the same file more than once
+        if cls.lock_count.get(self.lockfile, 0) > 0:
+            self.fd = cls.lock_handles[self.lockfile]
+            if cls.lock_shared[self.lockfile] and not self.shared:
+                self._flock(self.fd, fcntl.LOCK_EX)
+                cls.lock_shared[self.lockfile] = False
+            cls.lock_count[self.lockfile] += 1
+            self.is_locked = True
+            return
+        
+        lockdir = os.path.dirname(self.lockfile)
+        if not os.path.isdir(lockdir):
+            try:
+                os.makedirs(lockdir)
+            except OSError:
+                pass  # created by another process
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        while True:
+            fd = os.open(self.lockfile, os.O_CREAT|os.O_RDWR, 0o666)
+            try:
+                self._flock(fd, mode)
+            except:
+                os.close(fd)
+                raise
+            # The previous holder may have removed the lockfile while we were
+            # waiting, leaving us with a lock on an orphaned file; try again.
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.lockfile).st_ino:
+                    break
+            except OSError:
+                pass
+            os.close(fd)
+        
+        self.fd = fd
+        self.is_locked = True
+        cls.lock_count[self.lockfile] = 1
+        cls.lock_handles[self.lockfile] = fd
+        cls.lock_shared[self.lockfile] = self.shared
+ 
+    def release(self):
+        """ Release the lock. When working in a `with` statement, this gets 
+            automatically called at the end.
+        """
+        cls = FlockFileLock
+        if self.is_locked:
+            self.is_locked = False
+            cls.lock_count[self.lockfile] -= 1
+            if cls.lock_count[self.lockfile] == 0:
+                try:
+                    # Only remove the lockfile if no other process holds or
+                    # waits for it. (Waiting processes will notice that the
+                    # file was removed and retry.)
+                    if cls.lock_shared[self.lockfile]:
+                        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(self.lockfile)
+                except (IOError, OSError):
+                    pass
+                os.close(self.fd)
+                del cls.lock_handles[self.lockfile]
+                del cls.lock_shared[self.lockfile]
+
+    def _flock(self, fd, mode):
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if self._deadline is None or not self._can_alarm():
+            fcntl.flock(fd, mode)
+            return
+        remaining = self._deadline - time.time()
+        if remaining > 0:
+            old_handler = signal.signal(signal.SIGALRM, _alarm_handler)
+            try:
+                signal.setitimer(signal.ITIMER_REAL, remaining)
+                fcntl.flock(fd, mode)
+                return
+            except _LockTimeout:
+                pass
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, old_handler)
+        raise FileLockException("Timeout occured. (%s is locked by another process)" %
+                                self.lockfile)
+
+    @staticmethod
+    def _can_alarm():
+        return (hasattr(signal, 'setitimer') and 
+                isinstance(threading.current_thread(), threading._MainThread) and
+                signal.getitimer(signal.ITIMER_REAL)[0] == 0)
+ 
+    def __enter__(self):
+        """ Activated when used in the with statement. 
+            Should automatically acquire a lock to be used in the with block.
+        """
+        if not self.is_locked:
+            self.acquire()
+        return self
+ 
+    def __exit__(self, type, value, traceback):
+        """ Activated at the end of the with statement.
+            It automatically releases the lock if it isn't locked.
+        """
+        if self.is_locked:
+            self.release()
+ 
+    def __del__(self):
+        """ Make sure that the lock is released when the FlockFileLock 
+            instance is discarded.
+        """
+        self.release()
+
+
+if HAVE_FCNTL:
+    FileLock = FlockFileLock
+else:
+    FileLock = PollingFileLock
@@ -8,8 +8,13 @@ import scipy.io
 import numpy as np
 import tempfile
 import os, sys, glob, signal
+import threading
 import weakref
 import atexit
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue  # python 3.x
 
 
 class MatlabProcess(object):
@@ -62,6 +67,9 @@ class MatlabProcess(object):
     def __init__(self, executable=None, **kwds):
         self.__closed = False
         self.__refs = weakref.WeakValueDictionary()
+        # serializes commands that may be sent from several threads (for 
+        # example, MatlabReference.__del__)
+        self.__lock = threading.RLock()
         
         # Decide which executables to try
         if executable is not None:
@@ -118,11 +126,12 @@ class MatlabProcess(object):
         if cmd[-1] != '\n':
             cmd += '\n'
         cmd += "::cmd_done\n"
-        self.__proc.stdout.read()
-        self.__proc.stdin.write(cmd)
-        
-        if parse_result:
-            return self._parse_result()
+        with self.__lock:
+            self.__proc.stdout.read()
+            self.__proc.stdin.write(cmd)
+            
+            if parse_result:
+                return self._parse_result()
     
     def _parse_result(self):
         assert not self.__closed, "MATLAB process has already closed."
@@ -310,8 +319,6 @@ class MatlabFunction(object):
         If _transfer is False, then the return values are left in MATLAB and 
         references to these values are returned instead.
         """
-        import pyqtgraph as pg
-        
         _transfer = kwds.pop('_transfer', True)
         assert len(kwds) == 0
         
@@ -363,6 +370,159 @@ class MatlabFunction(object):
         return ret
         
 
+class MatlabFuture(object):
+    """ The pending result of a task submitted to a MatlabPool.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """ Return True if the task has finished (or failed).
+        """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the task to finish and return its result, or raise the
+        exception raised by the task.
+        """
+        exc = self.exception(timeout)
+        if exc is not None:
+            raise exc
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the task to finish and return the exception it raised, 
+        or None.
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timed out waiting for MATLAB task.")
+        return self._exception
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def _set_exception(self, exc):
+        self._exception = exc
+        self._event.set()
+
+
+class MatlabPool(object):
+    """ A pool of MatlabProcess workers that run tasks concurrently.
+    
+    Each worker process is served by its own thread; tasks are taken from a 
+    shared queue in the order they were submitted. A task is a callable that 
+    receives the worker's MatlabProcess as its first argument::
+    
+        pool = MatlabPool(4)
+        fut = pool.submit(lambda proc, n: proc.eye(n), 3)
+        fut.result()
+    
+    Because a task may run on any worker, it must not rely on state left in a
+    MATLAB workspace by a previous task (in particular, it should seed the 
+    random number generator itself if it uses random numbers).
+    
+    Parameters
+    ----------
+    n_workers : int
+        Number of MATLAB processes to start.
+    setup : callable or None
+        Called with the first MatlabProcess before the other workers are 
+        started; use this for one-time work such as compiling MEX files.
+    init : callable or None
+        Called with each MatlabProcess (including the first) after it starts.
+    **kwds :
+        Extra arguments passed to MatlabProcess (eg. executable, cwd).
+    """
+    def __init__(self, n_workers, setup=None, init=None, **kwds):
+        self._closed = False
+        first = MatlabProcess(**kwds)
+        if setup is not None:
+            setup(first)
+        # MATLAB is slow to start; launch the remaining workers concurrently
+        procs = [first] + [None] * (n_workers - 1)
+        errors = []
+        def start(i):
+            try:
+                procs[i] = MatlabProcess(**kwds)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=start, args=(i,)) for i in range(1, n_workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self._procs = [p for p in procs if p is not None]
+        if len(errors) > 0:
+            self._closed = True
+            for proc in self._procs:
+                proc.close()
+            raise errors[0]
+        if init is not None:
+            for proc in self._procs:
+                init(proc)
+        
+        self._tasks = Queue()
+        self._threads = []
+        for proc in self._procs:
+            t = threading.Thread(target=self._work, args=(proc,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._procs)
+
+    @property
+    def processes(self):
+        """ The list of MatlabProcess workers.
+        """
+        return self._procs[:]
+
+    def submit(self, fn, *args, **kwds):
+        """ Schedule ``fn(proc, *args, **kwds)`` to run on the next free worker
+        and return a MatlabFuture.
+        """
+        assert not self._closed, "MatlabPool has already closed."
+        fut = MatlabFuture()
+        self._tasks.put((fn, args, kwds, fut))
+        return fut
+
+    def map(self, fn, *iterables):
+        """ Run ``fn(proc, *args)`` for each set of arguments taken from 
+        *iterables* and return a list of the results, in order.
+        """
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return [fut.result() for fut in futures]
+
+    def close(self):
+        """ Wait for all submitted tasks to finish, then stop the workers.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for t in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
+        for proc in self._procs:
+            proc.close()
+
+    def _work(self, proc):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            fn, args, kwds, fut = task
+            try:
+                fut._set_result(fn(proc, *args, **kwds))
+            except Exception as exc:
+                fut._set_exception(exc)
+
+
 class MatlabError(Exception):
     def __init__(self, error, output):
         self.output = ''.join(output)
@@ -0,0 +1,145 @@
+"""
+Minimal stand-in for the MATLAB executable, used to test MatlabProcess and
+MatlabPool without MATLAB.
+
+It speaks the same stdin/stdout protocol as the bootstrap loop installed by
+MatlabProcess, and understands only the handful of statements that
+matlab_proc and an_model.wrapper send: function calls of the form
+``[a,b] = fn(x, 1.0);``, ``load``, ``save``, ``clear``, ``exist``,
+``nargout``, RandStream seeding and ``exit``. The auditory model functions
+are replaced by cheap (but deterministic, seeded) imitations.
+
+Usage: python matlab_stub.py [ignored matlab options]
+"""
+import sys, re
+import numpy as np
+import scipy.io
+
+
+def model_IHC(pin, CF, nrep, tdres, reptime, cohc, cihc, species):
+    n = int(round(float(reptime) / float(tdres))) * int(nrep)
+    pin = np.asarray(pin, dtype=float).ravel()
+    out = np.zeros((1, n))
+    out[0, :pin.size] = np.tanh(pin * 1e-2) * (float(CF) / 1e4)
+    return out
+
+
+def model_Synapse(vihc, CF, nrep, tdres, fiberType, noiseType, implnt):
+    meanrate = 50. * float(fiberType) + 1e4 * np.abs(np.asarray(vihc, dtype=float))
+    psth = (state['rng'].rand(*meanrate.shape) < meanrate * float(tdres)).astype(float)
+    return meanrate, meanrate.copy(), psth
+
+
+functions = {
+    'eye': (1, lambda n: np.eye(int(n))),
+    'ones': (1, lambda n: np.ones((int(n), int(n)))),
+    'rand': (1, lambda *shape: state['rng'].rand(*[int(s) for s in shape])),
+    'who': (1, lambda: np.array([[k] for k in sorted(workspace)], dtype=object).reshape(len(workspace), 1)),
+    'model_IHC': (None, model_IHC),
+    'model_Synapse': (None, model_Synapse),
+    'mexANmodel': (0, lambda: None),
+}
+workspace = {}
+state = {'rng': np.random.RandomState(0)}
+
+
+def out(strn):
+    sys.stdout.write(strn)
+    sys.stdout.flush()
+
+
+def value(token):
+    token = token.strip()
+    if token in workspace:
+        return workspace[token]
+    if token[:1] == "'":
+        return token.strip("'")
+    return float(token)
+
+
+def evaluate(cmd):
+    cmd = cmd.strip()
+    m = re.match(r"^(\w+);?$", cmd)
+    if m is not None and m.group(1) in functions:
+        functions[m.group(1)][1]()
+        return
+    m = re.match(r"^\[(.*)\]\s*=\s*(\w+)\((.*)\);?$", cmd, re.S)
+    if m is not None:
+        names = [n.strip() for n in m.group(1).split(',') if n.strip()]
+        fn = functions[m.group(2)][1]
+        args = [value(a) for a in m.group(3).split(',') if a.strip()]
+        ret = fn(*args)
+        if len(names) == 0:
+            ret = ()
+        elif len(names) == 1:
+            ret = (ret,)
+        for name, val in zip(names, ret):
+            workspace[name] = val
+        return
+    m = re.match(r"^exist (\w+)$", cmd)
+    if m is not None:
+        name = m.group(1)
+        out("%d\n" % (2 if name in functions else 1 if name in workspace else 0))
+        return
+    m = re.match(r"^fprintf\('%d\\n', nargout\('(\w+)'\)\);$", cmd)
+    if m is not None:
+        n = functions[m.group(1)][0]
+        if n is None:
+            raise Exception("nargout failed for %s" % m.group(1))
+        out("%d\n" % n)
+        return
+    m = re.match(r"^load\('(.*)'\);?$", cmd)
+    if m is not None:
+        data = scipy.io.loadmat(m.group(1))
+        for k, v in data.items():
+            if not k.startswith('__'):
+                workspace[k] = v
+        return
+    m = re.match(r"^save\('(.*)', '(\w+)', '-v7'\);?$", cmd)
+    if m is not None:
+        scipy.io.savemat(m.group(1), {m.group(2): workspace[m.group(2)]})
+        return
+    m = re.match(r"^clear ([\w ]+);?$", cmd)
+    if m is not None:
+        for name in m.group(1).split():
+            workspace.pop(name, None)
+        return
+    m = re.match(r"^RandStream.setGlobalStream\(RandStream\('mcg16807','seed',(\d+)\)\);$", cmd)
+    if m is not None:
+        state['rng'] = np.random.RandomState(int(m.group(1)))
+        return
+    if cmd in ('exit', 'exit;'):
+        sys.exit(0)
+    raise Exception("Unsupported statement: %s" % cmd)
+
+
+def main():
+    out("Stub MATLAB\nCopyright 2016 cnmodel\nVersion 0.0 (stub)\n")
+    # discard the bootstrap loop; its outermost block ends with this line
+    while True:
+        line = sys.stdin.readline()
+        if line == '' or line == '    end\n':
+            break
+    while True:
+        out('\n::ready\n')
+        cmd = []
+        while True:
+            line = sys.stdin.readline()
+            if line == '':
+                return
+            if line.strip() == '::cmd_done':
+                break
+            cmd.append(line)
+        try:
+            evaluate(''.join(cmd))
+            out('\n::ok\n')
+        except SystemExit:
+            raise
+        except Exception as err:
+            out('\n::err\n')
+            out('::message:%s\n' % str(err).replace('\n', ' '))
+            out('::identifier:stub:error\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os, time, tempfile
+import multiprocessing as mp
+import pytest
+from cnmodel.util import filelock
+from cnmodel.util.filelock import FileLock, FileLockException
+
+needs_flock = pytest.mark.skipif(not filelock.HAVE_FCNTL, reason="fcntl unavailable")
+
+
+def increment(args):
+    # Increment the counter in *filename* *n* times, each under a new lock
+    filename, n = args
+    for i in range(n):
+        with FileLock(filename):
+            with open(filename) as fh:
+                val = int(fh.read())
+            with open(filename, 'w') as fh:
+                fh.write(str(val + 1))
+    return n
+
+
+def hold_lock(filename, shared, ready, done):
+    with FileLock(filename, shared=shared):
+        ready.set()
+        done.wait(10)
+
+
+def die_holding_lock(filename):
+    lock = FileLock(filename)
+    lock.acquire()
+    os._exit(0)
+
+
+def test_stress():
+    # Many processes contending for one lock must never lose an update
+    filename = os.path.join(tempfile.mkdtemp(), 'counter')
+    with open(filename, 'w') as fh:
+        fh.write('0')
+    nproc, n = 8, 200
+    pool = mp.Pool(nproc)
+    start = time.time()
+    pool.map(increment, [(filename, n)] * nproc)
+    elapsed = time.time() - start
+    pool.close()
+    with open(filename) as fh:
+        assert int(fh.read()) == nproc * n
+    print("%s: %d locks in %0.2f s (%0.0f locks/s)" % (FileLock.__name__, nproc * n,
+                                                       elapsed, nproc * n / elapsed))
+    assert not os.path.exists(filename + '.lock')
+
+
+@needs_flock
+def test_shared():
+    filename = os.path.join(tempfile.mkdtemp(), 'data')
+    ready, done = mp.Event(), mp.Event()
+    proc = mp.Process(target=hold_lock, args=(filename, True, ready, done))
+    proc.start()
+    try:
+        assert ready.wait(10)
+        # readers do not exclude each other
+        with FileLock(filename, shared=True, timeout=1):
+            pass
+        # but a writer must wait for all readers
+        with pytest.raises(FileLockException):
+            with FileLock(filename, timeout=0.2):
+                pass
+    finally:
+        done.set()
+        proc.join()
+    with FileLock(filename, timeout=1):
+        pass
+    assert not os.path.exists(filename + '.lock')
+
+
+@needs_flock
+def test_dead_holder():
+    # A lock held by a process that died must not block others
+    filename = os.path.join(tempfile.mkdtemp(), 'data')
+    proc = mp.Process(target=die_holding_lock, args=(filename,))
+    proc.start()
+    proc.join()
+    assert os.path.exists(filename + '.lock')
+    with FileLock(filename, timeout=1):
+        pass
+    assert not os.path.exists(filename + '.lock')
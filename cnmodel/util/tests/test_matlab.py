@@ -1,16 +1,22 @@
+import os, sys, stat, tempfile
 import pytest
 import numpy as np
-from cnmodel.util.matlab_proc import MatlabProcess
+from cnmodel.util.matlab_proc import MatlabProcess, MatlabPool, MatlabError
 
 
-def test_matlab():
-    global proc
-    try:
-        proc = MatlabProcess()
-    except RuntimeError:
-        # no matlab available; skip this test
-        pytest.skip("MATLAB unavailable")
+def stub_matlab():
+    """ Return the path to an executable that runs matlab_stub.py in place of
+    MATLAB.
+    """
+    stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'matlab_stub.py')
+    exe = os.path.join(tempfile.mkdtemp(), 'matlab')
+    with open(exe, 'w') as fh:
+        fh.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, stub))
+    os.chmod(exe, os.stat(exe).st_mode | stat.S_IEXEC)
+    return exe
 
+
+def check_process(proc):
     base_vcount = proc.who().shape[0]
     
     e4 = proc.eye(4)
@@ -28,6 +34,46 @@ def test_matlab():
 
     proc.close()
 
+
+def test_matlab():
+    try:
+        proc = MatlabProcess()
+    except RuntimeError:
+        # no matlab available; skip this test
+        pytest.skip("MATLAB unavailable")
+    check_process(proc)
+
+
+def test_matlab_stub():
+    check_process(MatlabProcess(executable=stub_matlab()))
+
+
+def seeded_rand(proc, seed):
+    proc("RandStream.setGlobalStream(RandStream('mcg16807','seed',%d));" % seed)
+    return proc.rand(1, 5)
+
+
+def test_pool():
+    setup_calls = []
+    pool = MatlabPool(3, executable=stub_matlab(), setup=setup_calls.append)
+    try:
+        assert len(pool) == 3
+        assert setup_calls == pool.processes[:1]
+        
+        # results are reproducible regardless of which worker runs a task
+        seeds = list(range(12))
+        futures = [pool.submit(seeded_rand, seed) for seed in seeds]
+        results = [fut.result(timeout=30) for fut in futures]
+        assert np.all(pool.map(seeded_rand, seeds[::-1])[::-1] == np.array(results))
+        assert not np.all(results[0] == results[1])
+        
+        # errors are raised by result()
+        fut = pool.submit(lambda proc: proc('undefined_statement;'))
+        with pytest.raises(MatlabError):
+            fut.result(timeout=30)
+    finally:
+        pool.close()
+
     
 if __name__ == '__main__':
     test_matlab()